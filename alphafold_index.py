@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Description:
+    1. Find finished AlphaFold (ColabFold) prediction folders (with a .done.txt marker) under the given folders
+    2. For each model of each prediction (in parallel), summarize confidence:
+        i) mean plddt, fraction of residues with plddt > 70 and > 90, pTM, max and mean PAE
+        ii) mean plddt of each window of residues (--window), and the lowest
+        iii) domains (runs of at least --domain residues with plddt > 70), mean PAE within and between domains
+    3. Save one table with a row per model keyed by gene ID (e.g. Glyma.08G120500, same as extract_top_genes.py results)
+        i) Rerunning only summarizes new or changed prediction folders
+
+Usage:
+    python alphafold_index.py -f <PATH_TO_FOLDER/> [<PATH_TO_FOLDER/> ...] -r <path_to_result_filename.csv>
+
+        e.g.
+        python alphafold_index.py -f AlphaFold_five_nematode_GO_predicted_proteins/ Rhg1_and_Rhg4_proteins_AlphaFold_predictions/ -r alphafold_index.csv -w 8
+
+        Add -c <path_to_cache_folder/> to keep the score arrays there instead of inside each prediction folder (see alphafold_scores.py)
+"""
+
+import os
+import re
+import json
+import argparse
+import pandas as pd
+import numpy as np
+import tqdm
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from alphafold_scores import find_score_files, find_prediction_folders, get_sources, load_scores
+
+# Soy gene in prediction folder name, e.g. Glyma08G120500_e2ecd or Glyma18G022400_a71b9_0
+SOY_GENE = re.compile(r'^Glyma\.?(\d\d|U)(G\d+)')
+# Confident plddt cutoffs
+PLDDT_CONFIDENT = 70
+PLDDT_VERY_HIGH = 90
+
+# DEFINE COMMANDLINE ARGUMENTS
+describe_help = 'python alphafold_index.py -f PATH_TO_FOLDER/ -r alphafold_index.csv'
+parser = argparse.ArgumentParser(description=describe_help)
+parser.add_argument('-f', '--folders', help='Full path to prediction folder(s), or folder(s) of prediction folders', type=str, nargs='+')
+parser.add_argument('-r', '--result', help='Full path to result .csv file, updated if it exists', type=str, default=os.getcwd() + '/alphafold_index.csv')
+parser.add_argument('-c', '--cache', help='Folder to save score arrays under (default is inside each prediction folder)', type=str, default=None)
+parser.add_argument('-window', '--window', help='Number of residues in each plddt window', type=int, default=50)
+parser.add_argument('-domain', '--domain', help='Least number of residues in a confident domain', type=int, default=30)
+parser.add_argument('-w', '--workers', help='Number of processes for summarizing folders in parallel', type=int, default=1)
+
+def get_gene_id(prediction):
+    # Glyma08G120500_e2ecd -> Glyma.08G120500, other names lose the job suffix only
+    match = SOY_GENE.match(prediction)
+    if match is not None:
+        return 'Glyma.%s%s'%(match.group(1), match.group(2))
+    return prediction.split('_')[0]
+
+def is_done(folder):
+    prediction = os.path.basename(os.path.normpath(folder))
+    return os.path.exists(os.path.join(folder, prediction + '.done.txt'))
+
+def get_signature(folder):
+    # Changes whenever a score file is added, removed or rewritten
+    return json.dumps(get_sources(folder, find_score_files(folder)), sort_keys=True)
+
+def window_means(plddt, window):
+    # Mean plddt of consecutive windows of residues of every model, last window may be shorter
+    starts = np.arange(0, plddt.shape[1], window)
+    counts = np.diff(np.append(starts, plddt.shape[1]))
+    return np.add.reduceat(plddt, starts, axis=1) / counts
+
+def find_domains(plddt, min_length):
+    # Start and end (exclusive) of runs of confident residues
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], (plddt > PLDDT_CONFIDENT).astype(np.int8), [0]])))
+    starts, ends = edges[0::2], edges[1::2]
+    keep = ends - starts >= min_length
+    return starts[keep], ends[keep]
+
+def domain_pae(pae, starts, ends):
+    # Mean PAE within domains and between pairs of domains, block sums from one matrix product
+    if starts.shape[0] == 0:
+        return np.nan, np.nan
+    members = np.zeros((pae.shape[0], starts.shape[0]), dtype=np.float32)
+    for d in range(starts.shape[0]):
+        members[starts[d]:ends[d], d] = 1
+    sums = members.T @ np.asarray(pae, dtype=np.float32) @ members
+    sizes = ends - starts
+    counts = np.outer(sizes, sizes)
+    within = np.eye(starts.shape[0], dtype=bool)
+    between = np.nan if starts.shape[0] < 2 else sums[~within].sum() / counts[~within].sum()
+    return sums[within].sum() / counts[within].sum(), between
+
+def summarize_folder(folder, window, domain, cache=None):
+    # One row per model of the prediction in folder
+    prediction = os.path.basename(os.path.normpath(folder))
+    scores = load_scores(folder, cache=cache)
+    config = {}
+    if os.path.exists(os.path.join(folder, 'config.json')):
+        with open(os.path.join(folder, 'config.json')) as fh:
+            config = json.load(fh)
+
+    plddt = np.asarray(scores['plddt'], dtype=np.float32)
+    windows = window_means(plddt, window)
+    rows = []
+    for i in range(plddt.shape[0]):
+        starts, ends = find_domains(plddt[i], domain)
+        within, between = domain_pae(scores['pae'][i], starts, ends)
+        rows.append({
+            'Gene Name': get_gene_id(prediction),
+            'prediction': prediction,
+            'rank': int(scores['rank'][i]),
+            'model': int(scores['model'][i]),
+            'seed': int(scores['seed'][i]),
+            'residues': plddt.shape[1],
+            'mean_plddt': plddt[i].mean(),
+            'plddt_over_70': (plddt[i] > PLDDT_CONFIDENT).mean(),
+            'plddt_over_90': (plddt[i] > PLDDT_VERY_HIGH).mean(),
+            'ptm': float(scores['ptm'][i]),
+            'max_pae': float(scores['max_pae'][i]),
+            'mean_pae': float(np.asarray(scores['pae'][i], dtype=np.float32).mean()),
+            'min_window_plddt': windows[i].min(),
+            'window_plddt': ';'.join([ '%.1f'%w for w in windows[i] ]),
+            'domains': ';'.join([ '%s-%s'%(s + 1, e) for s, e in zip(starts, ends) ]),
+            'domain_pae': within,
+            'interdomain_pae': between,
+            'model_type': config.get('model_type'),
+            'msa_mode': config.get('msa_mode'),
+            'version': config.get('version'),
+            'folder': os.path.abspath(folder),
+            'signature': get_signature(folder),
+            })
+    return rows
+
+# MAIN RUN
+if __name__ == '__main__':
+    args = parser.parse_args()
+    # Show args for double-checking input
+    print(args)
+
+    folders = find_prediction_folders(args.folders)
+    unfinished = [ f for f in folders if not is_done(f) ]
+    folders = [ f for f in folders if is_done(f) ]
+    print('%s finished prediction folders, %s unfinished skipped'%(len(folders), len(unfinished)))
+
+    # Keep rows of folders summarized before and unchanged since
+    saved = pd.DataFrame()
+    if os.path.exists(args.result):
+        saved = pd.read_csv(args.result, dtype={'domains': str, 'window_plddt': str})
+        current = dict(( (os.path.abspath(f), get_signature(f)) for f in folders ))
+        unchanged = saved['folder'].map(current) == saved['signature']
+        # Rows of folders outside those given are kept as they are
+        outside = ~saved['folder'].isin(list(current)) & ~saved['folder'].map(lambda f: any([ f.startswith(os.path.abspath(p)) for p in args.folders ]))
+        saved = saved[unchanged | outside]
+        folders = [ f for f in folders if os.path.abspath(f) not in set(saved['folder']) ]
+    print('%s prediction folders to summarize...'%len(folders))
+
+    summarize = partial(summarize_folder, window=args.window, domain=args.domain, cache=args.cache)
+    if args.workers > 1:
+        executor = ProcessPoolExecutor(max_workers=args.workers)
+        results = executor.map(summarize, folders)
+    else:
+        executor = None
+        results = map(summarize, folders)
+    rows = []
+    for r in tqdm.tqdm(results, total=len(folders)):
+        rows.extend(r)
+    if executor is not None:
+        executor.shutdown()
+
+    final = pd.concat([saved, pd.DataFrame(rows)], ignore_index=True)
+    if not final.empty:
+        final = final.sort_values(by=['Gene Name', 'prediction', 'rank'], kind='mergesort')
+    # Replace file only once completely written
+    tmp = '%s.%s.tmp'%(args.result, os.getpid())
+    final.to_csv(tmp, index=False)
+    os.replace(tmp, args.result)
+    print('Saved %s models of %s genes to %s'%(final.shape[0], final['Gene Name'].nunique() if not final.empty else 0, args.result))
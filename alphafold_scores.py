@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Description:
+    Load AlphaFold (ColabFold) scores of prediction folders as NumPy arrays
+        i) Each *_scores_rank_00N_<model_type>_model_M_seed_S.json is parsed once, numbers go straight into arrays
+            (no nested Python lists), plddt as float32 and PAE as float16
+        ii) Arrays of all models of a folder are saved as .npy files and memory-mapped by later loads
+    Per model (in rank order): plddt (residues), PAE (residues x residues), pTM and max PAE
+
+Usage:
+    python alphafold_scores.py -f <PATH_TO_PREDICTION_FOLDER/> [<PATH_TO_PREDICTION_FOLDER/> ...] -c <path_to_cache_folder/>
+
+        e.g.
+        python alphafold_scores.py -f AlphaFold_five_nematode_GO_predicted_proteins/ Rhg1_and_Rhg4_proteins_AlphaFold_predictions/
+
+        A folder holding prediction folders converts all of them
+        Without -c arrays are saved under <prediction_folder>/arrays/ (ignored by git, see .gitignore)
+
+    From Python:
+        scores = load_scores('AlphaFold_five_nematode_GO_predicted_proteins/Glyma08G120500_e2ecd')
+        scores['plddt'][0], scores['pae'][0]    # best ranked model
+"""
+
+import os
+import re
+import json
+import argparse
+import numpy as np
+from interaction_matrix import save_atomic
+
+# Score file of one model, e.g. Glyma08G120500_e2ecd_scores_rank_001_alphafold2_ptm_model_2_seed_000.json
+SCORE_FILE = re.compile(r'_scores_rank_(\d+)_(.+)_model_(\d+)_seed_(\d+)\.json$')
+# Number value of a key in a score file
+NUMBER = r'"%s"\s*:\s*(-?[0-9.]+(?:[eE][-+]?[0-9]+)?)'
+# Arrays saved for each prediction folder
+ARRAYS = ('plddt', 'pae', 'ptm', 'max_pae', 'rank', 'model', 'seed')
+
+def find_score_files(folder):
+    # Score files of all models, best ranked first
+    found = []
+    for entry in os.scandir(folder):
+        match = SCORE_FILE.search(entry.name)
+        if match is not None and entry.is_file():
+            found.append((int(match.group(1)), int(match.group(3)), int(match.group(4)), entry.name))
+    return sorted(found)
+
+def read_number_list(text, key):
+    # Numbers of a list (or list of lists) value, parsed from the text without building Python lists
+    start = text.index('[', text.index('"%s"'%key))
+    nested = text[start+1:start+64].lstrip().startswith('[')
+    end = text.index(']]' if nested else ']', start)
+    values = np.fromstring(text[start:end].replace('[', ' ').replace(']', ' '), sep=',')
+    if nested:
+        size = int(round(np.sqrt(values.shape[0])))
+        values = values.reshape(size, size)
+    return values
+
+def read_number(text, key):
+    match = re.search(NUMBER%key, text)
+    return float(match.group(1)) if match is not None else np.nan
+
+def read_score_file(filename):
+    # plddt, PAE, pTM and max PAE of one model
+    with open(filename) as fh:
+        text = fh.read()
+    try:
+        return {'plddt': read_number_list(text, 'plddt').astype(np.float32),
+                'pae': read_number_list(text, 'pae').astype(np.float16),
+                'ptm': read_number(text, 'ptm'),
+                'max_pae': read_number(text, 'max_pae')}
+    except ValueError:
+        # Layout not as expected (e.g. reformatted file), fall back to full JSON parsing
+        scores = json.loads(text)
+        return {'plddt': np.asarray(scores['plddt'], dtype=np.float32),
+                'pae': np.asarray(scores['pae'], dtype=np.float16),
+                'ptm': float(scores.get('ptm', np.nan)),
+                'max_pae': float(scores.get('max_pae', np.nan))}
+
+def get_array_folder(folder, cache=None):
+    if cache is None:
+        return os.path.join(folder, 'arrays')
+    return os.path.join(cache, os.path.basename(os.path.normpath(folder)))
+
+def get_sources(folder, score_files):
+    # Size and modification time of score files, arrays are rebuilt if any changed
+    sources = {}
+    for rank, model, seed, f in score_files:
+        stat = os.stat(os.path.join(folder, f))
+        sources[f] = [stat.st_size, stat.st_mtime_ns]
+    return sources
+
+def convert_scores(folder, cache=None):
+    # Parse score files of folder into .npy arrays, skipped if arrays are up to date, returns array folder
+    array_folder = get_array_folder(folder, cache)
+    score_files = find_score_files(folder)
+    sources = get_sources(folder, score_files)
+    meta_file = os.path.join(array_folder, 'scores.json')
+    if os.path.exists(meta_file):
+        with open(meta_file) as fh:
+            if json.load(fh).get('sources') == sources:
+                return array_folder
+    if len(score_files) == 0:
+        raise FileNotFoundError('No AlphaFold score files in %s'%folder)
+
+    # Models are read one at a time into preallocated arrays
+    first = read_score_file(os.path.join(folder, score_files[0][3]))
+    residues = first['plddt'].shape[0]
+    arrays = {'plddt': np.empty((len(score_files), residues), dtype=np.float32),
+              'pae': np.empty((len(score_files), residues, residues), dtype=np.float16),
+              'ptm': np.empty(len(score_files), dtype=np.float32),
+              'max_pae': np.empty(len(score_files), dtype=np.float32),
+              'rank': np.array([ s[0] for s in score_files ], dtype=np.int16),
+              'model': np.array([ s[1] for s in score_files ], dtype=np.int16),
+              'seed': np.array([ s[2] for s in score_files ], dtype=np.int16)}
+    for i, (rank, model, seed, f) in enumerate(score_files):
+        scores = first if i == 0 else read_score_file(os.path.join(folder, f))
+        if scores['plddt'].shape[0] != residues:
+            raise ValueError('%s has %s residues, expected %s'%(f, scores['plddt'].shape[0], residues))
+        for key in ('plddt', 'pae', 'ptm', 'max_pae'):
+            arrays[key][i] = scores[key]
+
+    os.makedirs(array_folder, exist_ok=True)
+    for key in ARRAYS:
+        save_atomic(os.path.join(array_folder, key + '.npy'), arrays[key])
+    save_atomic(meta_file, {'folder': os.path.abspath(folder), 'residues': residues, 'files': [ s[3] for s in score_files ], 'sources': sources})
+    return array_folder
+
+def load_scores(folder, cache=None):
+    # Arrays of all models of folder (best ranked first), memory-mapped, converted first if needed
+    array_folder = convert_scores(folder, cache=cache)
+    scores = dict(( (key, np.load(os.path.join(array_folder, key + '.npy'), mmap_mode='r')) for key in ARRAYS ))
+    with open(os.path.join(array_folder, 'scores.json')) as fh:
+        scores['files'] = json.load(fh)['files']
+    return scores
+
+def find_prediction_folders(paths):
+    # Prediction folders given directly or found one level down
+    folders = []
+    for path in paths:
+        if len(find_score_files(path)) > 0:
+            folders.append(path)
+            continue
+        for entry in sorted(os.scandir(path), key=lambda e: e.name):
+            if entry.is_dir() and len(find_score_files(entry.path)) > 0:
+                folders.append(entry.path)
+    return folders
+
+# MAIN RUN
+if __name__ == '__main__':
+    # DEFINE COMMANDLINE ARGUMENTS
+    describe_help = 'python alphafold_scores.py -f PATH_TO_PREDICTION_FOLDER/ -c path_to_cache_folder/'
+    parser = argparse.ArgumentParser(description=describe_help)
+    parser.add_argument('-f', '--folders', help='Full path to prediction folder(s), or folder(s) of prediction folders', type=str, nargs='+')
+    parser.add_argument('-c', '--cache', help='Folder to save arrays under (default is inside each prediction folder)', type=str, default=None)
+    args = parser.parse_args()
+
+    for folder in find_prediction_folders(args.folders):
+        scores = load_scores(folder, cache=args.cache)
+        print('%s: %s models, %s residues, best pTM %.3f, mean plddt %.2f'%(
+            os.path.basename(os.path.normpath(folder)), scores['plddt'].shape[0], scores['plddt'].shape[1], scores['ptm'].max(), scores['plddt'][0].mean()))
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Description:
+    Read AlphaFold (ColabFold) PDB models into NumPy arrays and compare them
+        i) ATOM/HETATM records are cut at their fixed columns for all lines at once into a structured array
+            (model, chain, residue, residue name, atom name, element, xyz, occupancy, B-factor = plddt in AlphaFold models)
+        ii) CA contact maps from blocked distance computation (memory grows with block x residues, not residues x residues x 3)
+        iii) Consistency between the models of a prediction: RMSD and TM-style score after superposition, shared contacts
+
+Usage:
+    python alphafold_structures.py -f <PATH_TO_PREDICTION_FOLDER/> [<PATH_TO_PREDICTION_FOLDER/> ...] -r <path_to_result_filename.csv>
+
+        e.g.
+        python alphafold_structures.py -f AlphaFold_five_nematode_GO_predicted_proteins/ Rhg1_and_Rhg4_proteins_AlphaFold_predictions/ -r model_consistency.csv
+
+        A folder holding prediction folders compares the models of each of them, one row per model against the best ranked model
+
+    From Python:
+        atoms = read_pdb('Glyma08G120500_e2ecd_unrelaxed_rank_001_alphafold2_ptm_model_2_seed_000.pdb')
+        ca = get_ca(atoms)
+        i, j = contact_pairs(ca['xyz'], cutoff=8)
+"""
+
+import os
+import re
+import argparse
+import pandas as pd
+import numpy as np
+
+# Model file, e.g. Glyma08G120500_e2ecd_unrelaxed_rank_001_alphafold2_ptm_model_2_seed_000.pdb
+MODEL_FILE = re.compile(r'_(unrelaxed|relaxed)_rank_(\d+)_(.+)_model_(\d+)_seed_(\d+)\.pdb$')
+# Longest PDB record used
+LINE_WIDTH = 80
+# Atoms of one PDB record
+ATOM_DTYPE = np.dtype([('model', np.int16), ('chain', 'U1'), ('residue', np.int32), ('insertion', 'U1'), ('residue_name', 'U3'),
+                       ('atom', 'U4'), ('element', 'U2'), ('xyz', np.float32, (3,)), ('occupancy', np.float32), ('b_factor', np.float32)])
+# Number of residues compared against all others at once in distance computations
+BLOCK_ROWS = 1024
+
+def get_column(raw, start, end):
+    # Fixed columns [start, end) of all lines as bytes strings
+    return np.ascontiguousarray(raw[:, start:end]).view('S%s'%(end - start)).ravel()
+
+def read_pdb(filename):
+    # Structured array of all ATOM and HETATM records
+    with open(filename, 'rb') as fh:
+        lines = np.array(fh.read().splitlines(), dtype='S%s'%LINE_WIDTH)
+    raw = lines.view(np.uint8).reshape(lines.shape[0], LINE_WIDTH)
+    record = np.char.strip(get_column(raw, 0, 6))
+    is_atom = (record == b'ATOM') | (record == b'HETATM')
+    # Atoms before the first MODEL record belong to model 1
+    model = np.maximum(np.cumsum(record == b'MODEL'), 1)[is_atom]
+    raw = raw[is_atom]
+
+    atoms = np.empty(raw.shape[0], dtype=ATOM_DTYPE)
+    atoms['model'] = model
+    atoms['chain'] = np.char.decode(get_column(raw, 21, 22))
+    atoms['residue'] = get_column(raw, 22, 26).astype(np.int32)
+    atoms['insertion'] = np.char.decode(get_column(raw, 26, 27))
+    atoms['residue_name'] = np.char.decode(np.char.strip(get_column(raw, 17, 20)))
+    atoms['atom'] = np.char.decode(np.char.strip(get_column(raw, 12, 16)))
+    atoms['element'] = np.char.decode(np.char.strip(get_column(raw, 76, 78)))
+    atoms['xyz'] = np.stack([ get_column(raw, start, start + 8).astype(np.float32) for start in (30, 38, 46) ], axis=1)
+    atoms['occupancy'] = get_column(raw, 54, 60).astype(np.float32)
+    atoms['b_factor'] = get_column(raw, 60, 66).astype(np.float32)
+    return atoms
+
+def get_ca(atoms, model=1):
+    # CA atom of each residue of one model
+    return atoms[(atoms['atom'] == 'CA') & (atoms['model'] == model)]
+
+def contact_pairs(xyz, cutoff=8.0, min_separation=1):
+    # Residue pairs (i < j, at least min_separation apart in sequence) closer than cutoff, one block of rows at a time
+    xyz = np.asarray(xyz, dtype=np.float32)
+    norms = (xyz * xyz).sum(axis=1)
+    found_i, found_j = [np.array([], dtype=np.int64)], [np.array([], dtype=np.int64)]
+    for start in range(0, xyz.shape[0], BLOCK_ROWS):
+        block = xyz[start:start+BLOCK_ROWS]
+        distances = norms[start:start+BLOCK_ROWS, None] + norms[None, :] - 2 * block @ xyz.T
+        i, j = np.nonzero(distances < cutoff * cutoff)
+        i += start
+        keep = j - i >= min_separation
+        found_i.append(i[keep])
+        found_j.append(j[keep])
+    return np.concatenate(found_i), np.concatenate(found_j)
+
+def contact_map(xyz, cutoff=8.0, min_separation=1):
+    # Symmetric boolean residues x residues map of contacts
+    i, j = contact_pairs(xyz, cutoff=cutoff, min_separation=min_separation)
+    contacts = np.zeros((len(xyz), len(xyz)), dtype=bool)
+    contacts[i, j] = True
+    contacts[j, i] = True
+    return contacts
+
+def superpose(mobile, target):
+    # Kabsch superposition of mobile onto target for a stack of coordinate sets (models x residues x 3)
+    mobile = mobile - mobile.mean(axis=1, keepdims=True)
+    target = target - target.mean(axis=1, keepdims=True)
+    u, s, vt = np.linalg.svd(np.swapaxes(mobile, 1, 2) @ target)
+    # Avoid reflections
+    d = np.sign(np.linalg.det(u @ vt))
+    u[:, :, -1] *= d[:, None]
+    return mobile @ (u @ vt), target
+
+def model_consistency(models, cutoff=8.0):
+    # RMSD, TM-style score and shared contacts of every model against the first, models are CA coordinates (models x residues x 3)
+    # The TM-style score uses the RMSD superposition (no TM-score search), so it is a lower bound of TM-score
+    models = np.asarray(models, dtype=np.float64)
+    residues = models.shape[1]
+    target = np.repeat(models[:1], models.shape[0], axis=0)
+    moved, target = superpose(models, target)
+    distances = np.sqrt(((moved - target) ** 2).sum(axis=2))
+    d0 = max(1.24 * np.cbrt(max(residues - 15, 1)) - 1.8, 0.5)
+
+    # Contacts as i * residues + j keys, shared is the fraction of contacts of either model found in both
+    keys = []
+    for m in models:
+        i, j = contact_pairs(m, cutoff=cutoff, min_separation=3)
+        keys.append(i.astype(np.int64) * residues + j)
+    shared = [ np.intersect1d(keys[0], k).shape[0] / max(np.union1d(keys[0], k).shape[0], 1) for k in keys ]
+    return pd.DataFrame({'rmsd': np.sqrt((distances ** 2).mean(axis=1)),
+                         'tm_score': (1 / (1 + (distances / d0) ** 2)).mean(axis=1),
+                         'shared_contacts': shared})
+
+def find_model_files(folder):
+    # PDB models of a prediction, best ranked first
+    found = []
+    for entry in os.scandir(folder):
+        match = MODEL_FILE.search(entry.name)
+        if match is not None and entry.is_file():
+            found.append((int(match.group(2)), int(match.group(4)), entry.name))
+    return sorted(found)
+
+def compare_models(folder, cutoff=8.0):
+    # One row per model of the prediction in folder, compared with the best ranked model
+    model_files = find_model_files(folder)
+    cas = [ get_ca(read_pdb(os.path.join(folder, f))) for rank, model, f in model_files ]
+    result = model_consistency([ ca['xyz'] for ca in cas ], cutoff=cutoff)
+    result.insert(0, 'prediction', os.path.basename(os.path.normpath(folder)))
+    result.insert(1, 'rank', [ m[0] for m in model_files ])
+    result.insert(2, 'model', [ m[1] for m in model_files ])
+    result.insert(3, 'residues', [ ca.shape[0] for ca in cas ])
+    result['mean_plddt'] = [ ca['b_factor'].mean() for ca in cas ]
+    result['contacts'] = [ contact_pairs(ca['xyz'], cutoff=cutoff, min_separation=3)[0].shape[0] for ca in cas ]
+    return result
+
+# MAIN RUN
+if __name__ == '__main__':
+    # DEFINE COMMANDLINE ARGUMENTS
+    describe_help = 'python alphafold_structures.py -f PATH_TO_PREDICTION_FOLDER/ -r model_consistency.csv'
+    parser = argparse.ArgumentParser(description=describe_help)
+    parser.add_argument('-f', '--folders', help='Full path to prediction folder(s), or folder(s) of prediction folders', type=str, nargs='+')
+    parser.add_argument('-d', '--distance', help='Distance (Angstrom) between CA atoms of residues in contact', type=float, default=8.0)
+    parser.add_argument('-r', '--result', help='Full path to result .csv file', type=str, default=None)
+    args = parser.parse_args()
+
+    folders = []
+    for path in args.folders:
+        if len(find_model_files(path)) > 0:
+            folders.append(path)
+        else:
+            folders.extend(sorted([ e.path for e in os.scandir(path) if e.is_dir() and len(find_model_files(e.path)) > 0 ]))
+
+    results = []
+    for folder in folders:
+        result = compare_models(folder, cutoff=args.distance)
+        print(result.to_string(index=False))
+        results.append(result)
+
+    if args.result is not None and len(results) > 0:
+        pd.concat(results).to_csv(args.result, index=False)
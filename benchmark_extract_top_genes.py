@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Description:
+    Benchmark the stages of extract_top_genes.py on synthetic data, nothing is needed beyond the local machine
+    1. Generate (from a seed) a folder of one-to-all .csv gene files and a matching fasta file
+        i) Soy genes (Glyma.*) with several isoforms of random length, pathogen genes (Hetgly.*) and other interactors
+        ii) Each file scores every interactor once (rows per file set with -n)
+    2. Time each stage: isoform selection, file discovery, top interactors of each file, result assembly,
+       Excel writing and resume scan (with and without manifest)
+    3. Report seconds, files/s, MB/s and peak memory (RSS) of each stage as JSON, to compare versions
+
+Usage:
+    python benchmark_extract_top_genes.py -g <number_of_soy_genes> -p <number_of_pathogen_genes> -n <rows_per_file> -o <path_to_result.json>
+
+        e.g.
+        python benchmark_extract_top_genes.py -g 500 -p 200 -n 5000 -t 40 -o benchmark.json
+
+        Add -w <number_of_processes> to time the top interactors stage with processes as extract_top_genes.py -w does
+        Add -c to also time a second top interactors pass reading from the binary cache (extract_top_genes.py -c)
+        Add -d <path_to_folder/> to keep the synthetic data there (otherwise a temporary folder is used and removed)
+"""
+
+import os
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import pandas as pd
+import numpy as np
+import openpyxl
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+import extract_top_genes as etg
+from instrumentation import peak_rss_mb
+
+# DEFINE COMMANDLINE ARGUMENTS
+describe_help = 'python benchmark_extract_top_genes.py -g 500 -p 200 -n 5000 -o benchmark.json'
+parser = argparse.ArgumentParser(description=describe_help)
+parser.add_argument('-g', '--soy_genes', help='Number of soy genes', type=int, default=200)
+parser.add_argument('-i', '--isoforms', help='Most isoforms of a soy gene (each gene has 1 to this many)', type=int, default=3)
+parser.add_argument('-p', '--pathogen_genes', help='Number of pathogen genes', type=int, default=100)
+parser.add_argument('-n', '--rows', help='Rows (interactors) per gene file, soy and pathogen interactors first then others', type=int, default=2000)
+parser.add_argument('-t', '--top', help='Number of top interactors', type=int, default=40)
+parser.add_argument('-w', '--workers', help='Number of processes for top interactors stage', type=int, default=1)
+parser.add_argument('-c', '--cache', help='Flag to also time top interactors from the binary cache', action='store_true')
+parser.add_argument('-s', '--seed', help='Seed of synthetic data', type=int, default=0)
+parser.add_argument('-d', '--folder', help='Folder to keep synthetic data and results in (default is a temporary folder)', type=str, default=None)
+parser.add_argument('-o', '--output', help='Full path to .json file for the report (also printed)', type=str, default=None)
+
+def generate_data(folder, soy_genes, isoforms, pathogen_genes, rows, seed=0):
+    # Seeded one-to-all gene files and fasta, returns (gene files folder, fasta file)
+    rng = np.random.default_rng(seed)
+    files_folder = os.path.join(folder, 'preds') + os.sep
+    os.makedirs(files_folder, exist_ok=True)
+
+    # Soy isoforms on chromosomes 1 to 20 and scaffolds, pathogen transcripts
+    soy = []
+    lengths = []
+    for i in range(soy_genes):
+        gene = 'Glyma.U%06d'%(i * 100) if i % 23 == 0 else 'Glyma.%02dG%06d'%(i % 20 + 1, i * 100)
+        for k in range(1, rng.integers(1, isoforms + 1) + 1):
+            soy.append('%s.%s'%(gene, k))
+            lengths.append(int(rng.integers(50, 1500)))
+    pathogen = [ 'Hetgly.g%05d.t1'%i for i in range(pathogen_genes) ]
+    lengths.extend(rng.integers(50, 1500, pathogen_genes).tolist())
+
+    amino_acids = np.array(list('ACDEFGHIKLMNPQRSTVWY'))
+    with open(os.path.join(folder, 'proteins.fa'), 'w') as fh:
+        for name, length in zip(soy + pathogen, lengths):
+            sequence = ''.join(amino_acids[rng.integers(0, 20, length)])
+            fh.write('>%s.p pacid=0\n'%name if name.startswith('Glyma') else '>%s\n'%name)
+            fh.write('\n'.join([ sequence[j:j+60] for j in range(0, length, 60) ]) + '\n')
+
+    # Interactors are soy and pathogen proteins, then other organisms to fill rows (dropped by filters)
+    interactors = np.array(soy + pathogen + [ 'Other.x%s.1'%i for i in range(max(rows - len(soy) - len(pathogen), 0)) ])[:rows]
+    for query in soy + pathogen:
+        order = rng.permutation(interactors.shape[0])
+        pd.DataFrame({'Protein A': query, 'Protein B': interactors[order], 'Score': np.round(rng.random(interactors.shape[0]), 4)}) \
+            .to_csv(files_folder + query + '.csv', index=False)
+    return files_folder, os.path.join(folder, 'proteins.fa')
+
+def run_stage(report, name, function, files=0, bytes_read=0):
+    # Time one stage, recording throughput and peak memory after it
+    t_start = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - t_start
+    report['stages'][name] = {
+        'seconds': seconds,
+        'files': files,
+        'files_per_second': files / seconds if files and seconds > 0 else None,
+        'mb_per_second': bytes_read / 1e6 / seconds if bytes_read and seconds > 0 else None,
+        'peak_rss_mb': peak_rss_mb(),
+        }
+    print('%s: %.3f s'%(name, seconds))
+    return result
+
+def top_interactors(files, folder, top, prefix, workers=1, cache=None):
+    # Top interactors of every file, as the main loop of extract_top_genes.py gets them
+    extract = partial(etg.get_top_interactors, folder=folder, prefix=prefix, cache=cache)
+    tops = [ {'all': top} ] * len(files)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(extract, files, tops, chunksize=max(1, len(files) // (workers * 16))))
+    else:
+        results = list(map(extract, files, tops))
+    return dict(( (gene, {'gene': gene, 'top': top, 'interactors': list(selected['all'][0]), 'isoforms': list(selected['all'][1])})
+                  for gene, selected, stats in results ))
+
+def resume_scan(result, manifest=True):
+    # Genes saved in a result workbook, from manifest or by reading the workbook
+    if not manifest and os.path.exists(etg.get_manifest_file(result)):
+        os.remove(etg.get_manifest_file(result))
+    return etg.get_saved_genes_sheet(result)
+
+# MAIN RUN
+if __name__ == '__main__':
+    args = parser.parse_args()
+    folder = args.folder if args.folder is not None else tempfile.mkdtemp(prefix='benchmark_extract_top_genes_')
+    prefix = 'Hetgly'
+    report = {
+        'parameters': vars(args),
+        'machine': {'platform': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count(),
+                    'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__, 'openpyxl': openpyxl.__version__},
+        'stages': {},
+        }
+    try:
+        print('Generating synthetic data in %s...'%folder)
+        files_folder, fasta = run_stage(report, 'generate', lambda: generate_data(folder, args.soy_genes, args.isoforms, args.pathogen_genes, args.rows, seed=args.seed))
+        gene_files = etg.list_gene_files(files_folder)
+        report['data'] = {'gene_files': len(gene_files), 'bytes': sum([ os.path.getsize(files_folder + f) for f in gene_files ]),
+                          'fasta_bytes': os.path.getsize(fasta)}
+
+        # Isoform index is written next to the fasta, time building it (first run) and reading it back (later runs)
+        for f in os.listdir(folder):
+            if f.endswith('.isoforms.json'):
+                os.remove(os.path.join(folder, f))
+        isoforms, many_longest = run_stage(report, 'isoform_selection', lambda: etg.get_isoforms(fasta), bytes_read=report['data']['fasta_bytes'])
+        run_stage(report, 'isoform_selection_indexed', lambda: etg.get_isoforms(fasta))
+
+        def discover():
+            relevant = set(isoforms.values)
+            return [ f for f in etg.select_gene_files(etg.list_gene_files(files_folder), prefix, 'all') if f.replace('.csv', '') in relevant ]
+        files = run_stage(report, 'file_discovery', discover, files=len(gene_files))
+        files_bytes = sum([ os.path.getsize(files_folder + f) for f in files ])
+
+        # Cache of an earlier benchmark in the same folder is removed so the first pass reads the .csv files
+        cache = os.path.join(folder, 'cache') if args.cache else None
+        if cache is not None:
+            shutil.rmtree(cache, ignore_errors=True)
+        records = run_stage(report, 'top_interactors', lambda: top_interactors(files, files_folder, args.top, prefix, workers=args.workers, cache=cache),
+                            files=len(files), bytes_read=files_bytes)
+        if cache is not None:
+            records = run_stage(report, 'top_interactors_cached', lambda: top_interactors(files, files_folder, args.top, prefix, workers=args.workers, cache=cache),
+                                files=len(files), bytes_read=files_bytes)
+
+        final, final_isoforms = run_stage(report, 'result_assembly', lambda: etg.build_result(records, args.top), files=len(files))
+
+        result = os.path.join(folder, 'top.xlsx')
+        for f in (result, etg.get_isoform_result(result)):
+            for path in (f, etg.get_manifest_file(f)):
+                if os.path.exists(path):
+                    os.remove(path)
+        run_stage(report, 'excel_writing', lambda: (etg.write_to_excel(result, final), etg.write_to_excel(etg.get_isoform_result(result), final_isoforms)),
+                  files=len(files))
+        report['data']['result_bytes'] = os.path.getsize(result) + os.path.getsize(etg.get_isoform_result(result))
+
+        run_stage(report, 'resume_scan', lambda: resume_scan(result), files=1, bytes_read=os.path.getsize(result))
+        run_stage(report, 'resume_scan_no_manifest', lambda: resume_scan(result, manifest=False), files=1, bytes_read=os.path.getsize(result))
+    finally:
+        if args.folder is None:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    report['peak_rss_mb'] = peak_rss_mb()
+    print(json.dumps(report, indent=2))
+    if args.output is not None:
+        with open(args.output, 'w') as fh:
+            json.dump(report, fh, indent=2)
@@ -7,7 +7,7 @@ Description:
     1. Read files in folder where each file contains one-to-all gene interactions and scores.
         i) Only keep longest-sequenced gene isoform if different isoforms exist in files
     2. For each file:
-        i) Sort interactors in descending order by score (last column in each file)
+        i) Rank interactors in descending order by score (last column in each file), keeping the best scoring isoform of each interactor gene
         ii) Pull top X (20 for soy-pathogen, 40 for soy-soy) scoring interactors for given gene file (# top scorers is an option)
         iii) Calculate % of top scorers that include genes of interest
     3. Add top scorers to Excel under gene column
@@ -25,6 +25,24 @@ Usage:
         
         Where soy-soy/ contains all gene .csv prediction files
         This will create an Excel with top 40 scorers saved as soy_top40.xlsx under Documents/SOY/
+        
+        Add -w <number_of_processes> to read gene files in parallel (e.g. -w 32), results are the same as a single process run
+        Add -c <path_to_cache_folder/> to keep binary copies of the parsed gene files, later runs on the same files skip reading the .csv files
+        
+        Several results can be made from one read of the files, e.g. -t 20 40 -m all pathogen_only soy_only
+        makes soy_top20.xlsx, soy_top20_pathogen_only.xlsx, soy_top20_soy_only.xlsx, soy_top40.xlsx, ... from -r soy.xlsx
+        
+        Add -i <path_to_genes_file> to use another list of genes of interest (one gene per line) instead of GENES_OF_INTEREST
+        
+        Add -x <path_to_matrix_folder/> to also save the top --matrix_top (1000) scores of each gene as a sparse matrix for fast queries,
+        see interaction_matrix.py
+        
+        Add -shard <i/k> to process only shard i of k of the gene files (e.g. one cluster job each for 1/4 ... 4/4),
+        then run the same command with -merge instead to add all shard results to the result files
+        
+        Stage and file timings are logged to <result>_log.jsonl (or -log <path>), add -profile <path_to_stats.prof> to also profile the run
+        
+        Completed genes are saved under <result>_checkpoint/ while running, rerunning the same command after a crash continues from there
     
 Requirements:
     This worked using the following (newer isoforms may also work):
@@ -45,362 +63,901 @@ import pandas as pd
 import numpy as np
 import tqdm
 import time
-from openpyxl import load_workbook
-from openpyxl.worksheet.worksheet import Worksheet
+import re
+import heapq
+import json
+import hashlib
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from openpyxl import Workbook, load_workbook
+from interaction_matrix import write_matrix_part, build_matrix, get_matrix_files, save_atomic
+from instrumentation import start_log, stage, log_stage, log_file, summarize, start_profile, stop_profile
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, PatternFill, Border, Side, Alignment
 
-# DEFINE GENES OF INTEREST TO HIGHLIGHT RED IN EXCEL AND REPORT % FOUND IN TOP SCORERS
-GENES_OF_INTEREST = [
+# DEFINE GENES OF INTEREST TO HIGHLIGHT RED IN EXCEL AND REPORT % FOUND IN TOP SCORERS (replaced by --interest file if given)
+GENES_OF_INTEREST = frozenset([
     'Glyma.06G093500', 'Glyma.04G091700', 'Glyma.02G213400', 'Glyma.14G181100', 'Glyma.01G023900', 'Glyma.02G040900', 'Glyma.07G220900',
     'Glyma.20G019200', 'Glyma.20G049600', 'Glyma.03G129000', 'Glyma.04G227600', 'Glyma.13G097600', 'Glyma.17G062000', 'Glyma.08G001800',
     'Glyma.15G162300', 'Glyma.09G056100', 'Glyma.05G152000', 'Glyma.08G108800', 'Glyma.18G263000', 'Glyma.11G254700', 'Glyma.18G266800',
     'Glyma.13G073000', 'Glyma.U018700', 'Glyma.05G239400', 'Glyma.03G181900', 'Glyma.08G046500', 'Glyma.05G183500', 'Glyma.10G058000',
     'Glyma.13G144800', 'Glyma.09G205000', 'Glyma.13G129500', 'Glyma.01G018000', 'Glyma.08G019100', 'Glyma.11G080700', 'Glyma.19G182400',
     'Glyma.10G264300', 'Glyma.09G090000', 'Glyma.14G185700', 'Glyma.02G218300', 'Glyma.14G105700', 'Glyma.15G169800', 'Glyma.09G063100',
-    'Glyma.13G350500', 'Glyma.05G171400', 'Glyma.05G152000', 'Glyma.08G108800', 'Glyma.11G254700', 'Glyma.12G078400', 'Glyma.08G209500',
-    'Glyma.06G263000', 'Glyma.12G078300', 'Glyma.18G054400', 'Glyma.11G160400', 'Glyma.03G031900', 'Glyma.15G024000', 'Glyma.01G136100',
-    'Glyma.08G129900', 'Glyma.12G139600', 'Glyma.04G173700', 'Glyma.09G018500', 'Glyma.15G124600', 'Glyma.02G196200', 'Glyma.17G003400',
-    'Glyma.07G270600', 'Glyma.12G189000', 'Glyma.13G312700', 'Glyma.13G064800', 'Glyma.12G095100', 'Glyma.10G262600', 'Glyma.12G028800',
-    'Glyma.11G103900', 'Glyma.13G314900', 'Glyma.02G195900', 'Glyma.19G199300', 'Glyma.03G202600', 'Glyma.10G180600', 'Glyma.18G040000',
-    'Glyma.12G186600', 'Glyma.19G200200', 'Glyma.05G140400', 'Glyma.12G032500', 'Glyma.06G136900', 'Glyma.04G228000', 'Glyma.11G107500',
-    'Glyma.06G093500', 'Glyma.04G004000', 'Glyma.06G003600', 'Glyma.05G189100', 'Glyma.05G140400', 'Glyma.03G088500', 'Glyma.08G095800',
-    'Glyma.18G040000', 'Glyma.16G084800', 'Glyma.09G228500', 'Glyma.12G008000', 'Glyma.11G216500', 'Glyma.10G258300', 'Glyma.04G091700',
+    'Glyma.13G350500', 'Glyma.05G171400', 'Glyma.12G078400', 'Glyma.08G209500', 'Glyma.06G263000', 'Glyma.12G078300', 'Glyma.18G054400',
+    'Glyma.11G160400', 'Glyma.03G031900', 'Glyma.15G024000', 'Glyma.01G136100', 'Glyma.08G129900', 'Glyma.12G139600', 'Glyma.04G173700',
+    'Glyma.09G018500', 'Glyma.15G124600', 'Glyma.02G196200', 'Glyma.17G003400', 'Glyma.07G270600', 'Glyma.12G189000', 'Glyma.13G312700',
+    'Glyma.13G064800', 'Glyma.12G095100', 'Glyma.10G262600', 'Glyma.12G028800', 'Glyma.11G103900', 'Glyma.13G314900', 'Glyma.02G195900',
+    'Glyma.19G199300', 'Glyma.03G202600', 'Glyma.10G180600', 'Glyma.18G040000', 'Glyma.12G186600', 'Glyma.19G200200', 'Glyma.05G140400',
+    'Glyma.12G032500', 'Glyma.06G136900', 'Glyma.04G228000', 'Glyma.11G107500', 'Glyma.04G004000', 'Glyma.06G003600', 'Glyma.05G189100',
+    'Glyma.03G088500', 'Glyma.08G095800', 'Glyma.16G084800', 'Glyma.09G228500', 'Glyma.12G008000', 'Glyma.11G216500', 'Glyma.10G258300',
     'Glyma.20G132800', 'Glyma.08G146800', 'Glyma.20G133400', 'Glyma.12G128600', 'Glyma.16G044800', 'Glyma.06G277000', 'Glyma.19G106900',
-    'Glyma.02G213400', 'Glyma.06G198400', 'Glyma.14G181100', 'Glyma.03G009500', 'Glyma.01G023900', 'Glyma.17G074700', 'Glyma.08G014900',
-    'Glyma.02G040900', 'Glyma.07G071000', 'Glyma.02G203000', 'Glyma.03G026900', 'Glyma.20G049600', 'Glyma.05G208300', 'Glyma.01G140600',
-    'Glyma.03G129000', 'Glyma.08G111500', 'Glyma.05G153800', 'Glyma.07G198600', 'Glyma.13G237800', 'Glyma.15G075600', 'Glyma.18G151800',
-    'Glyma.13G177800', 'Glyma.08G343800', 'Glyma.02G191200', 'Glyma.03G253000', 'Glyma.19G250600', 'Glyma.16G082800', 'Glyma.03G090700',
-    'Glyma.18G074100', 'Glyma.13G314900', 'Glyma.08G332900', 'Glyma.02G302500', 'Glyma.12G186600', 'Glyma.14G011600', 'Glyma.17G220000',
-    'Glyma.08G350600', 'Glyma.01G145800', 'Glyma.08G320500', 'Glyma.01G050600', 'Glyma.10G155800', 'Glyma.03G198400', 'Glyma.20G232500',
-    'Glyma.18G165200', 'Glyma.19G196300', 'Glyma.07G118700', 'Glyma.10G134000', 'Glyma.16G178800', 'Glyma.20G037900', 'Glyma.15G047500',
-    'Glyma.08G185200', 'Glyma.09G131500', 'Glyma.17G182500', 'Glyma.19G098200', 'Glyma.04G128200', 'Glyma.08G032900', 'Glyma.07G152400',
-    'Glyma.12G014500', 'Glyma.18G203500', 'Glyma.01G119600', 'Glyma.11G110500', 'Glyma.03G056000', 'Glyma.10G281800', 'Glyma.11G063900',
-    'Glyma.20G107500', 'Glyma.02G059000', 'Glyma.16G141700', 'Glyma.01G178300', 'Glyma.15G047500', 'Glyma.01G003800', 'Glyma.19G144800',
-    'Glyma.07G128100', 'Glyma.16G097900', 'Glyma.08G185200', 'Glyma.10G155800', 'Glyma.20G232500', 'Glyma.07G072100', 'Glyma.03G011000',
-    'Glyma.08G286500', 'Glyma.13G341100', 'Glyma.U027700', 'Glyma.11G134000', 'Glyma.12G058100', 'Glyma.05G207400', 'Glyma.08G014100',
-    'Glyma.08G093400', 'Glyma.04G010700', 'Glyma.01G107900', 'Glyma.13G326600', 'Glyma.14G023000', 'Glyma.19G247400', 'Glyma.15G033300',
-    'Glyma.02G062700', 'Glyma.13G126600', 'Glyma.20G227500', 'Glyma.19G042300', 'Glyma.17G120900', 'Glyma.05G012900', 'Glyma.06G178800',
-    'Glyma.15G169800', 'Glyma.09G063100', 'Glyma.13G350500', 'Glyma.05G040600', 'Glyma.06G076000', 'Glyma.04G075000', 'Glyma.04G200500',
-    'Glyma.04G123800', 'Glyma.17G085700', 'Glyma.04G187000', 'Glyma.01G245100', 'Glyma.15G024000', 'Glyma.06G165000', 'Glyma.04G000200',
-    'Glyma.06G000100', 'Glyma.19G102000', 'Glyma.11G000300', 'Glyma.12G098900', 'Glyma.06G305700', 'Glyma.12G193800', 'Glyma.13G308700',
-    'Glyma.16G049400', 'Glyma.16G147200', 'Glyma.11G080600', 'Glyma.01G162800', 'Glyma.05G035900', 'Glyma.06G178700', 'Glyma.09G035500',
-    'Glyma.08G072300', 'Glyma.08G008200', 'Glyma.15G047500', 'Glyma.17G091500', 'Glyma.08G185200', 'Glyma.09G136900', 'Glyma.15G140000',
-    'Glyma.08G072200', 'Glyma.16G182300'
-    ]
+    'Glyma.06G198400', 'Glyma.03G009500', 'Glyma.17G074700', 'Glyma.08G014900', 'Glyma.07G071000', 'Glyma.02G203000', 'Glyma.03G026900',
+    'Glyma.05G208300', 'Glyma.01G140600', 'Glyma.08G111500', 'Glyma.05G153800', 'Glyma.07G198600', 'Glyma.13G237800', 'Glyma.15G075600',
+    'Glyma.18G151800', 'Glyma.13G177800', 'Glyma.08G343800', 'Glyma.02G191200', 'Glyma.03G253000', 'Glyma.19G250600', 'Glyma.16G082800',
+    'Glyma.03G090700', 'Glyma.18G074100', 'Glyma.08G332900', 'Glyma.02G302500', 'Glyma.14G011600', 'Glyma.17G220000', 'Glyma.08G350600',
+    'Glyma.01G145800', 'Glyma.08G320500', 'Glyma.01G050600', 'Glyma.10G155800', 'Glyma.03G198400', 'Glyma.20G232500', 'Glyma.18G165200',
+    'Glyma.19G196300', 'Glyma.07G118700', 'Glyma.10G134000', 'Glyma.16G178800', 'Glyma.20G037900', 'Glyma.15G047500', 'Glyma.08G185200',
+    'Glyma.09G131500', 'Glyma.17G182500', 'Glyma.19G098200', 'Glyma.04G128200', 'Glyma.08G032900', 'Glyma.07G152400', 'Glyma.12G014500',
+    'Glyma.18G203500', 'Glyma.01G119600', 'Glyma.11G110500', 'Glyma.03G056000', 'Glyma.10G281800', 'Glyma.11G063900', 'Glyma.20G107500',
+    'Glyma.02G059000', 'Glyma.16G141700', 'Glyma.01G178300', 'Glyma.01G003800', 'Glyma.19G144800', 'Glyma.07G128100', 'Glyma.16G097900',
+    'Glyma.07G072100', 'Glyma.03G011000', 'Glyma.08G286500', 'Glyma.13G341100', 'Glyma.U027700', 'Glyma.11G134000', 'Glyma.12G058100',
+    'Glyma.05G207400', 'Glyma.08G014100', 'Glyma.08G093400', 'Glyma.04G010700', 'Glyma.01G107900', 'Glyma.13G326600', 'Glyma.14G023000',
+    'Glyma.19G247400', 'Glyma.15G033300', 'Glyma.02G062700', 'Glyma.13G126600', 'Glyma.20G227500', 'Glyma.19G042300', 'Glyma.17G120900',
+    'Glyma.05G012900', 'Glyma.06G178800', 'Glyma.05G040600', 'Glyma.06G076000', 'Glyma.04G075000', 'Glyma.04G200500', 'Glyma.04G123800',
+    'Glyma.17G085700', 'Glyma.04G187000', 'Glyma.01G245100', 'Glyma.06G165000', 'Glyma.04G000200', 'Glyma.06G000100', 'Glyma.19G102000',
+    'Glyma.11G000300', 'Glyma.12G098900', 'Glyma.06G305700', 'Glyma.12G193800', 'Glyma.13G308700', 'Glyma.16G049400', 'Glyma.16G147200',
+    'Glyma.11G080600', 'Glyma.01G162800', 'Glyma.05G035900', 'Glyma.06G178700', 'Glyma.09G035500', 'Glyma.08G072300', 'Glyma.08G008200',
+    'Glyma.17G091500', 'Glyma.09G136900', 'Glyma.15G140000', 'Glyma.08G072200', 'Glyma.16G182300'
+    ])
 
 MAX_SHEETS = 200
 MAX_COLS = 800
 
+# EXCEL CELL STYLES, HEADER AS WRITTEN BY PANDAS AND GENES OF INTEREST RED ON PINK
+HEADER_FONT = Font(bold=True)
+HEADER_BORDER = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
+HEADER_ALIGNMENT = Alignment(horizontal='center', vertical='top')
+INTEREST_FONT = Font(color='FF0000')
+INTEREST_FILL = PatternFill(fill_type='solid', start_color='FFC0CB', end_color='FFC0CB')
+OTHER_FONT = Font(color='000000')
+# Rows of a gene file read at once when selecting top interactors
+CHUNK_ROWS = 100000
+# End of sequence ID in fasta headers
+FASTA_ID_END = re.compile(r'.p| ')
+# Chromosome of soy gene names, e.g. Glyma.08G120500 (U for scaffolds)
+CHROMOSOME = re.compile(r'^Glyma\.(\d\d|U)')
+# Interactor filters (pathogen_only, soy_only) of each mode
+MODES = {'all': (False, False), 'pathogen_only': (True, False), 'soy_only': (False, True)}
+# Interactor IDs seen by this process, as integer codes (see get_vocabulary)
+VOCABULARY = {}
+
 # DEFINE COMMANDLINE ARGUMENTS
 describe_help = 'python extract_top_genes.py -f PATH_TO_FOLDER/ -r path_to_result_filename.csv -t 40 -s sequences.fasta'
 parser = argparse.ArgumentParser(description=describe_help)
 parser.add_argument('-f', '--files', help='Full path to folder with .csv gene files', type=str)
 parser.add_argument('-r', '--result', help='Full path to result file', type=str, default=os.getcwd() + '/top_genes.xlsx')
-parser.add_argument('-t', '--top', help='Number of top interactors to include', type=int)
+parser.add_argument('-t', '--top', help='Number of top interactors to include (several numbers give one result per number)', type=int, nargs='+')
 parser.add_argument('-s', '--sequences', help='Full path to fasta file containing all sequences', type=str)
 parser.add_argument('-a', '--all', help='Flag to all gene isoforms', action='store_true')
 parser.add_argument('-pathogen_only', '--pathogen_only', help='Flag to extract only pathogen scores from any soy gene files', action='store_true')
 parser.add_argument('-soy_only', '--soy_only', help='Flag to extract only soy scores from any pathogen gene files', action='store_true')
+parser.add_argument('-m', '--modes', help='Run several of all, pathogen_only, soy_only from one read of the files (one result per mode)', type=str, nargs='+', choices=['all', 'pathogen_only', 'soy_only'], default=None)
 parser.add_argument('-p', '--prefix', help='Prefix of pathogen gene names for searching/filtering', type=str, default='Hetgly')
-args = parser.parse_args()
+parser.add_argument('-c', '--cache', help='Folder for binary copies of parsed gene files, reused by later runs (e.g. different --top)', type=str, default=None)
+parser.add_argument('-i', '--interest', help='File with genes of interest (one per line) to use instead of GENES_OF_INTEREST', type=str, default=None)
+parser.add_argument('-checkpoint_every', '--checkpoint_every', help='Save completed genes to checkpoint after this many files', type=int, default=500)
+parser.add_argument('-checkpoint_seconds', '--checkpoint_seconds', help='Save completed genes to checkpoint after this many seconds', type=float, default=300)
+parser.add_argument('-x', '--matrix', help='Folder to export interaction scores to as a sparse matrix (see interaction_matrix.py)', type=str, default=None)
+parser.add_argument('-matrix_top', '--matrix_top', help='Number of top interactors of each gene to keep in the matrix', type=int, default=1000)
+parser.add_argument('-shard', '--shard', help='Only process shard i of k (e.g. 1/4), results are saved as <result>_shard<i>of<k> for --merge', type=str, default=None)
+parser.add_argument('-shard_by', '--shard_by', help='Split genes over shards by hash of gene name or by chromosome', type=str, choices=['hash', 'chromosome'], default='hash')
+parser.add_argument('-merge', '--merge', help='Flag to merge all shard results into the result files (and build --matrix)', action='store_true')
+parser.add_argument('-log', '--log', help='JSON lines file for stage and file timings (default is <result>_log.jsonl)', type=str, default=None)
+parser.add_argument('-profile', '--profile', help='File to save cProfile stats of the run to (main process only)', type=str, default=None)
+parser.add_argument('-w', '--workers', help='Number of processes for reading gene files in parallel', type=int, default=1)
 
 # DEFINE USEFUL FUNCTIONS
-def get_isoforms(df_fasta):
-    # Format df for easier use columns as ID, SEQUENCE
-    df = df_fasta.copy()
-    seq_id = df.iloc[::2, :].reset_index(drop=True)
-    seq = df.iloc[1::2, :].reset_index(drop=True)
-    seq_id.insert(1, 1, seq)
-    seq_id[0] = seq_id[0].str.replace('>', '')
-    seq_id[0] = seq_id[0].str.replace(r'.p', ' ', regex=True)
-    seq_id[0] = [ i[0] for i in seq_id[0].str.split(' ') ]
-    df = seq_id.copy()
-    print('\t%s total genes in sequences file.'%df.shape[0])
-    
-    # Sort genes by having single or multi isoforms
-    isoforms = np.array([ v[-1] for v in df[0].str.split('.') ])
-    df.insert(2, 'Isoform', isoforms)
-    df[0] = np.array([ '.'.join(i[:-1]) for i in df[0].str.split('.') ])
-    seq_lengths = np.array([ len(i) for i in df[1] ])
-    df = pd.DataFrame(data={0: df[0], 1: seq_lengths, 'Isoform': df['Isoform']})
-    multi_isoforms = df[df.duplicated(subset=[0], keep=False)]
-    multi_isoforms.reset_index(drop=True, inplace=True)
-    single_isoforms = df[~df[0].isin(multi_isoforms[0].unique())]
-    single_isoforms.reset_index(drop=True, inplace=True)
-    
-    # Sort multi isoforms by sequence length
-    #multi_isoforms = multi_isoforms.sort_values(by=[0,1], ascending=False)
-    multi_isoforms = multi_isoforms.sort_values(by=[0,'Isoform'], ascending=True)
-    multi_isoforms.reset_index(inplace=True, drop=True)
-    
-    # Get multi isoforms with same length
-    same_length = multi_isoforms[multi_isoforms.duplicated(subset=[0,1], keep=False)]
-    same_length.reset_index(drop=True, inplace=True)
+def file_checksum(filename):
+    # SHA-1 of file contents, read in blocks
+    checksum = hashlib.sha1()
+    with open(filename, 'rb') as fh:
+        for block in iter(lambda: fh.read(1 << 20), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+def read_fasta_lengths(filename):
+    # Stream fasta file keeping only sequence IDs and lengths, sequences may be wrapped over many lines
+    ids = []
+    lengths = []
+    with open(filename) as fh:
+        for line in fh:
+            line = line.rstrip('\r\n')
+            if line.startswith('>'):
+                # ID ends at first space or '.p' (e.g. >Glyma.01G000100.1.p pacid=...)
+                header = line.replace('>', '')
+                end = FASTA_ID_END.search(header)
+                ids.append(header[:end.start()] if end else header)
+                lengths.append(0)
+            elif ids:
+                lengths[-1] += len(line)
+    return ids, lengths
+
+def build_isoform_index(ids, lengths):
+    # Gene name is the ID without isoform number (after the last '.')
+    df = pd.DataFrame(data={'id': ids, 'length': lengths})
+    parts = df['id'].str.rpartition('.')
+    df['gene'] = parts[0]
+    df['isoform'] = parts[2]
+    df.sort_values(by=['gene', 'isoform'], kind='mergesort', inplace=True)
     
-    # Get longest isoforms from genes with multiple isoforms
-    longest = multi_isoforms.drop_duplicates(subset=[0], keep='first')
+    # Isoform kept for each gene is the first when sorted by isoform number
+    chosen = ~df.duplicated(subset=['gene'])
+    df['chosen'] = chosen.values
     
-    # Get genes with multiple equally longest isoforms
-    many_longest = same_length.merge(longest, on=[0, 1])
-    many_longest.drop(columns='Isoform_y', inplace=True)
-    many_longest.rename(columns={'Isoform_x': 'Isoform'}, inplace=True)
-    many_longest.reset_index(drop=True, inplace=True)
+    # Record genes with other isoforms of the same length as the one kept
+    chosen_length = df.loc[chosen, ['gene', 'length']].set_index('gene')['length']
+    same_length = df['length'] == df['gene'].map(chosen_length)
+    df['tied'] = same_length & (same_length.groupby(df['gene']).transform('sum') >= 2)
     
-    # Combine all longest isoforms and all genes with only one isoform, removing redundant
-    isoforms = longest.append(many_longest, ignore_index=True)
-    isoforms = isoforms.append(single_isoforms, ignore_index=True)
-    isoforms = isoforms.drop_duplicates(subset=[0, 1])
-    isoforms.reset_index(drop=True, inplace=True)
-    isoforms.sort_values(by=[0, 'Isoform'], inplace=True)
-    isoforms.reset_index(drop=True, inplace=True)
-    isoforms[0] = isoforms[0] + '.' + isoforms['Isoform']
+    return df[df['chosen'] | df['tied']].reset_index(drop=True)
+
+def get_isoforms(sequences, index_folder=None):
+    # Isoform index is saved next to the sequences (or in index_folder) keyed by checksum of the sequences file
+    checksum = file_checksum(sequences)
+    if index_folder is None:
+        index_folder = os.path.dirname(os.path.abspath(sequences))
+    index_file = os.path.join(index_folder, '%s.%s.isoforms.json'%(os.path.basename(sequences), checksum[:16]))
+    if os.path.exists(index_file):
+        with open(index_file) as fh:
+            saved = json.load(fh)
+        index = pd.DataFrame(data=saved['isoforms'], columns=saved['columns'])
+    else:
+        ids, lengths = read_fasta_lengths(sequences)
+        index = build_isoform_index(ids, lengths)
+        saved = {'sequences': len(ids), 'checksum': checksum, 'columns': list(index.columns), 'isoforms': index.values.tolist()}
+        try:
+            os.makedirs(index_folder, exist_ok=True)
+            save_atomic(index_file, saved)
+        except OSError as e:
+            # e.g. shared read-only reference folder, index is only kept for this run (use -c to save it elsewhere)
+            print('Warning: could not save isoform index to %s (%s), use -c to save it in a writable folder'%(index_file, e))
+    print('\t%s total genes in sequences file.'%saved['sequences'])
     
-    many_longest[0] = many_longest[0] + '.' + many_longest['Isoform']
+    isoforms = index.loc[index['chosen'], 'id'].reset_index(drop=True)
+    many_longest = index.loc[index['tied'], 'id'].reset_index(drop=True)
 
-    return isoforms[0], many_longest[0]
+    return isoforms, many_longest
     
-def highlight_genes(gene):
-    bg_color = 'pink' if pd.Series([gene]).isin(GENES_OF_INTEREST)[0] == True else 'none'
-    return 'background-color: %s' % (bg_color)
-def color_genes(gene):
-    color = 'red' if pd.Series([gene]).isin(GENES_OF_INTEREST)[0] == True else 'black'
-    return 'color: %s' % (color)
+def get_manifest_file(filename):
+    # Sidecar file recording what is saved in an Excel result file
+    return filename + '.manifest.jsonl'
+
+def write_manifest(filename, sheets, rollover=None):
+    # First line describes workbook (file stamp, sheet order, file continued in after rollover), then one line per sheet
+    stat = os.stat(filename)
+    lines = [json.dumps({'workbook': os.path.abspath(filename), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 
+                         'sheets': [ sheet for sheet, genes in sheets ], 'rollover': rollover})]
+    for sheet, genes in sheets:
+        lines.append(json.dumps({'sheet': sheet, 'columns': len(genes), 'genes': [ str(g) for g in genes ]}))
+    save_atomic(get_manifest_file(filename), '\n'.join(lines) + '\n')
+
+def read_manifest(filename):
+    # Return (workbook info, [(sheet, genes), ...]) or None if manifest is missing or out of date with the workbook
+    manifest = get_manifest_file(filename)
+    if not os.path.exists(manifest):
+        return None
+    with open(manifest) as fh:
+        lines = [ json.loads(line) for line in fh if line.strip() ]
+    stat = os.stat(filename)
+    if len(lines) == 0 or lines[0]['size'] != stat.st_size or lines[0]['mtime_ns'] != stat.st_mtime_ns:
+        return None
+    return lines[0], [ (line['sheet'], line['genes']) for line in lines[1:] ]
+
+def rebuild_manifest(filename):
+    # Only read header row of each sheet, gene names are the column names
+    book = load_workbook(filename, read_only=True)
+    sheets = []
+    for ws in book.worksheets:
+        header = next(ws.iter_rows(max_row=1, values_only=True), ())
+        sheets.append((ws.title, [ g for g in header if g is not None ]))
+    book.close()
+    write_manifest(filename, sheets)
+    return read_manifest(filename)
 
 def get_saved_genes_sheet(filename, sheetname=None):
+    # Returns genes saved, sheet to continue in and result file to continue with
     # Start new Excel file if not found
     if sheetname == None:
         sheet = 'Sheet1'
     else:
         sheet = sheetname
     if not os.path.exists(filename):
-        return np.array([], dtype=str), sheet
+        return np.array([], dtype=str), sheet, filename
     
-    # Get list of gene columns already recorded
-    genes_recorded = np.array([], dtype=str)
-    excel_file = pd.ExcelFile(filename)
+    # Saved gene columns from manifest, only reading workbook if no manifest yet
+    saved = read_manifest(filename)
+    if saved is None:
+        print('Indexing saved genes in %s...'%filename)
+        saved = rebuild_manifest(filename)
+    info, sheets = saved
+    genes_recorded = np.array([ g for _, genes in sheets for g in genes ], dtype=str)
     
-    # Start new file if file sheets are maxed out
-    if len(excel_file.sheet_names) > MAX_SHEETS:
-        args.result = ''.join(args.result[:-1]) + '_new.' + args.result[-1]
-    
-    # Record saved gene columns
-    for sheets in excel_file.sheet_names:
-        genes_recorded = np.append(genes_recorded, excel_file.parse(sheets).columns)
+    # Start new file if file sheets are maxed out, genes saved there are also skipped
+    if len(sheets) > MAX_SHEETS:
+        if info['rollover'] is None:
+            info['rollover'] = os.path.splitext(filename)[0] + '_new' + os.path.splitext(filename)[1]
+            write_manifest(filename, sheets, rollover=info['rollover'])
+        genes_new_file, sheet, filename = get_saved_genes_sheet(info['rollover'], sheetname)
+        return np.append(genes_recorded, genes_new_file), sheet, filename
     
     # Get current sheetname and number of columns used
-    num_cols = excel_file.parse(sheet).shape[1]
+    num_cols = dict(( (name, len(genes)) for name, genes in sheets )).get(sheet, 0)
     if num_cols < MAX_COLS:
-        return genes_recorded, sheet
+        return genes_recorded, sheet, filename
     else:
-        return genes_recorded, "".join(filter(lambda x: not x.isdigit(), sheetname))+str(len(excel_file.sheet_names)+1)
+        return genes_recorded, "".join(filter(lambda x: not x.isdigit(), sheet))+str(len(sheets)+1), filename
     
-def write_to_excel(file, df):
-    saved_genes, sheet = get_saved_genes_sheet(file)
-    # Create file to append if not existing
-    if not os.path.exists(file):
-        writer = pd.ExcelWriter(file, engine='openpyxl')
-        pd.DataFrame().to_excel(writer, sheet_name=sheet, index=False)
-        writer.save()
-        writer.close()
-        
-    # Load file to append
-    book = load_workbook(file)
-    writer = pd.ExcelWriter(file, engine='openpyxl', mode='a')
-    writer.book = book
-    writer.sheets = dict((ws.title, ws) for ws in book.worksheets)
+def read_sheet_columns(ws):
+    # Get gene columns (with values) saved in one sheet
+    columns = {}
+    rows = list(ws.iter_rows(values_only=True))
+    if len(rows) == 0:
+        return columns
+    for c, gene in enumerate(rows[0]):
+        if gene is not None:
+            columns[gene] = pd.Series([ r[c] if c < len(r) else None for r in rows[1:] ], dtype=object)
+    return columns
+
+def read_excel_columns(filename):
+    # Get gene columns (with values) saved in all sheets of an Excel file
+    columns = {}
+    book = load_workbook(filename, read_only=True)
+    for ws in book.worksheets:
+        columns.update(read_sheet_columns(ws))
+    book.close()
+    return pd.DataFrame(columns)
+
+def write_sheet(ws, df, interested):
+    # Stream header and rows, interested marks cells with genes of interest
+    header = []
+    for gene in df.columns:
+        cell = WriteOnlyCell(ws, value=gene)
+        cell.font, cell.border, cell.alignment = HEADER_FONT, HEADER_BORDER, HEADER_ALIGNMENT
+        header.append(cell)
+    ws.append(header)
+    
+    values = df.values
+    empty = pd.isna(df).values
+    for r in range(values.shape[0]):
+        row = []
+        for c in range(values.shape[1]):
+            cell = WriteOnlyCell(ws, value=None if empty[r, c] else values[r, c])
+            if interested[r, c]:
+                cell.font, cell.fill = INTEREST_FONT, INTEREST_FILL
+            else:
+                cell.font = OTHER_FONT
+            row.append(cell)
+        ws.append(row)
+
+def write_to_excel(file, df, interest=GENES_OF_INTEREST):
+    # Include gene columns already saved in file, whole workbook is rewritten in one pass
+    # Saved columns are read one sheet at a time as the sheets they go in are written, memory grows with a sheet, not the workbook
+    saved_sheets = {}
+    saved_book = None
+    if os.path.exists(file):
+        saved = read_manifest(file)
+        if saved is None:
+            saved = rebuild_manifest(file)
+        saved_sheets = dict(( (gene, sheet) for sheet, genes in saved[1] for gene in genes if gene not in df.columns ))
+        saved_book = load_workbook(file, read_only=True)
+    loaded = {'sheet': None, 'columns': {}}
+    
+    def get_sheet(columns):
+        # New columns of df and saved columns, saved sheets are loaded when first needed (in order, each is normally loaded once)
+        data = {}
+        for gene in columns:
+            if gene in df.columns:
+                data[gene] = df[gene].reset_index(drop=True)
+                continue
+            if loaded['sheet'] != saved_sheets[gene]:
+                loaded['sheet'], loaded['columns'] = saved_sheets[gene], read_sheet_columns(saved_book[saved_sheets[gene]])
+            data[gene] = loaded['columns'][gene]
+        return pd.DataFrame(data)
+    
+    all_columns = sorted(set(df.columns) | set(saved_sheets))
+    book = Workbook(write_only=True)
+    # First sheet holds pathogen gene columns (Sheet1, Sheet2, ...)
+    pathogen_sheet = book.create_sheet('Sheet1')
+    sheets = [('Sheet1', [])]
     
     # Add SOY gene columns first
-    #pbar = tqdm.tqdm(total=np.array(df[[ x for x in df.columns if 'Glyma' in x ]]).shape[0])
-    pbar = tqdm.tqdm(total=df.columns.isin(saved_genes).shape[0] - df.columns.isin(saved_genes).sum())
+    pbar = tqdm.tqdm(total=len(all_columns))
+    soy_columns = set()
     for i in range(0, 21):
-        to_write, sheet = get_df_chromosome(df, num=i)
-        if to_write.empty:
+        columns, sheet = get_chromosome_columns(all_columns, num=i)
+        if len(columns) == 0:
             continue
-        excel = to_write.style.applymap(highlight_genes)
-        excel = excel.applymap(color_genes)
-        excel.to_excel(writer, sheet_name=sheet, index=False)
-        saved_genes = np.append(saved_genes, to_write.columns)
-        Worksheet(book, title=sheet)
-        pbar.update(to_write.shape[1])
-        df.drop(columns=to_write.columns, inplace=True)
-        
-    writer.save()
-    writer.close()
-    #pbar.close()
-    
-    # Load file to append
-    book = load_workbook(file)
-    writer = pd.ExcelWriter(file, engine='openpyxl', mode='a')
-    writer.book = book
-    writer.sheets = dict((ws.title, ws) for ws in book.worksheets)
+        to_write = get_sheet(columns)
+        # Find genes of interest in all cells of the sheet at once
+        write_sheet(book.create_sheet(sheet), to_write, to_write.isin(interest).values)
+        sheets.append((sheet, columns))
+        soy_columns.update(columns)
+        pbar.update(len(columns))
     
     # Add pathogen gene columns until completed
-    cols = 0
-    sheet_num = 1
-    sheet = 'Sheet1'
-    #pbar = tqdm.tqdm(total=df.columns.isin(saved_genes).shape[0] - df.columns.isin(saved_genes).sum())
-    while not all(df.columns.isin(saved_genes)):
-        to_write = df[df.columns[cols:cols+MAX_COLS]]
-        #to_write = get_df_chromosome(df, num=sheet_num)
-        excel = to_write.style.applymap(highlight_genes)
-        excel = excel.applymap(color_genes)
-        excel.to_excel(writer, sheet_name=sheet, index=False)
-        saved_genes = np.append(saved_genes, to_write.columns)
-        sheet = "".join(filter(lambda x: not x.isdigit(), sheet))+str(sheet_num+1)
-        Worksheet(book, title=sheet)
-        pbar.update(to_write.shape[1])
-        sheet_num += 1
-        cols += MAX_COLS
-        
-    writer.save()
-    writer.close()
+    pathogen_columns = [ c for c in all_columns if c not in soy_columns ]
+    for sheet_num, cols in enumerate(range(0, len(pathogen_columns), MAX_COLS), start=1):
+        columns = pathogen_columns[cols:cols+MAX_COLS]
+        to_write = get_sheet(columns)
+        if sheet_num == 1:
+            ws = pathogen_sheet
+            sheets[0] = ('Sheet1', columns)
+        else:
+            ws = book.create_sheet('Sheet%s'%sheet_num)
+            sheets.append(('Sheet%s'%sheet_num, columns))
+        write_sheet(ws, to_write, to_write.isin(interest).values)
+        pbar.update(len(columns))
     pbar.close()
+    if saved_book is not None:
+        saved_book.close()
     
-def get_df_chromosome(df, num=0):
+    # Replace file only once completely written
+    tmp = '%s.%s.tmp'%(file, os.getpid())
+    book.save(tmp)
+    os.replace(tmp, file)
+    write_manifest(file, sheets)
+    
+def get_chromosome_columns(columns, num=0):
     if num == 0:
-        chromosome_soy = df[[ c for c in df.columns if 'Glyma.U' in c ]]
+        chromosome_soy = [ c for c in columns if 'Glyma.U' in c ]
         sheet = 'Soy Chromosome U'
     else:
-        chromosome_soy = df[[ c for c in df.columns if ('Glyma.' +('%s'%num).zfill(2) + 'G') in c ]]
+        chromosome_soy = [ c for c in columns if ('Glyma.' +('%s'%num).zfill(2) + 'G') in c ]
         sheet = 'Soy Chromosome %s'%num
     
     return chromosome_soy, sheet
 
-def show_duration(t_start):
-    # Display duration of run
-    t_duration = time.time() - t_start
-    day = t_duration // (24 * 3600)
-    t_duration = t_duration % (24 * 3600)
-    hour = t_duration // 3600
-    t_duration %= 3600
-    minutes = t_duration // 60
-    t_duration %= 60
-    seconds = t_duration
-    print('Days', day)
-    print('Hours', hour)
-    print('Minutes', minutes)
-    print('Seconds', seconds)
+def get_vocabulary(prefix):
+    # One vocabulary per process and pathogen prefix, built up as gene files are read
+    if prefix not in VOCABULARY:
+        VOCABULARY[prefix] = {
+            'interactors': pd.Index([], dtype=object),      # interactor ID for each code
+            'is_soy': np.array([], dtype=bool),
+            'is_pathogen': np.array([], dtype=bool),
+            'gene': np.array([], dtype=np.int64),           # code of interactor gene (isoform number removed)
+            'isoform': np.array([], dtype=object),          # isoform number (after the last '.')
+            'genes': pd.Index([], dtype=object),            # gene name for each gene code
+            'dictionaries': {},                             # codes for cached dictionaries already seen
+            'prefix': prefix
+            }
+    return VOCABULARY[prefix]
+
+def encode_interactors(vocabulary, interactors):
+    # Map interactor IDs to integer codes, only IDs never seen before get any string processing
+    interactors = pd.Series(interactors, dtype=object).fillna('').values
+    codes = vocabulary['interactors'].get_indexer(interactors)
+    new = codes == -1
+    if new.any():
+        names = pd.Series(pd.unique(interactors[new]), dtype=object)
+        parts = names.str.rpartition('.')
+        genes = vocabulary['genes'].append(pd.Index(pd.unique(parts[0].values)).difference(vocabulary['genes'], sort=False))
+        vocabulary['genes'] = genes
+        vocabulary['interactors'] = vocabulary['interactors'].append(pd.Index(names))
+        vocabulary['is_soy'] = np.concatenate([vocabulary['is_soy'], names.str.contains('Glyma', regex=False).values])
+        vocabulary['is_pathogen'] = np.concatenate([vocabulary['is_pathogen'], names.str.contains(vocabulary['prefix'], regex=False).values])
+        vocabulary['gene'] = np.concatenate([vocabulary['gene'], genes.get_indexer(parts[0].values)])
+        vocabulary['isoform'] = np.concatenate([vocabulary['isoform'], parts[2].values])
+        codes[new] = vocabulary['interactors'].get_indexer(interactors[new])
+    return codes
+
+def update_top_heap(heap, in_heap, top, genes, codes, scores, rows):
+    # Keep a bounded min-heap of the best scoring isoform per interactor gene (isoform number removed)
+    # Entries are [score, -row, gene code, interactor code] so ties on score are won by the earlier row in the file,
+    # the same order a stable descending sort followed by drop_duplicates gives
+    if scores.shape[0] == 0:
+        return
+    
+    # Only rows reaching the top-th best gene score of this chunk can make the top list
+    gene_best = pd.Series(scores).groupby(genes).max().values
+    threshold = -np.inf
+    if gene_best.shape[0] > top:
+        threshold = np.partition(gene_best, gene_best.shape[0] - top)[gene_best.shape[0] - top]
+    # When the heap is full, a later row must beat its weakest entry outright
+    if len(heap) == top:
+        candidates = np.flatnonzero((scores >= threshold) & (scores > heap[0][0]))
+    else:
+        candidates = np.flatnonzero(scores >= threshold)
+    
+    for i in candidates:
+        entry = [scores[i], -rows[i], genes[i], codes[i]]
+        current = in_heap.get(genes[i])
+        if current is not None:
+            # Best isoform wins, replace in place
+            if entry > current:
+                current[:] = entry
+                heapq.heapify(heap)
+        elif len(heap) < top:
+            heapq.heappush(heap, entry)
+            in_heap[genes[i]] = entry
+        elif entry > heap[0]:
+            removed = heapq.heapreplace(heap, entry)
+            del in_heap[removed[2]]
+            in_heap[genes[i]] = entry
+
+def select_top_interactors(chunks, tops, vocabulary, stats=None):
+    # Rank interactors for every mode in tops ({mode: number of top interactors}) from one read of the file
+    # stats (if given) counts rows kept by the filters of each mode
+    heaps = dict(( (mode, ([], {})) for mode in tops ))
+    row = 0
+    for codes, scores in chunks:
+        scores = pd.to_numeric(pd.Series(scores), errors='coerce').fillna(-np.inf).values
+        rows = np.arange(row, row + scores.shape[0])
+        row += scores.shape[0]
+        
+        # Remove any genes that are not SOY or pathogen
+        is_soy = vocabulary['is_soy'][codes]
+        is_pathogen = vocabulary['is_pathogen'][codes]
+        for mode in tops:
+            keep = is_soy | is_pathogen
+            # If only want to consider non-Soy (or only Soy) genes for interactor scores
+            pathogen_only, soy_only = MODES[mode]
+            if pathogen_only:
+                keep &= is_pathogen
+            if soy_only:
+                keep &= is_soy
+            if stats is not None:
+                stats['rows_kept'][mode] = stats['rows_kept'].get(mode, 0) + int(keep.sum())
+            heap, in_heap = heaps[mode]
+            update_top_heap(heap, in_heap, tops[mode], vocabulary['gene'][codes[keep]], codes[keep], scores[keep], rows[keep])
+    
+    # Descending by score, ties by position in file
+    selected = {}
+    for mode in tops:
+        ranked = sorted(heaps[mode][0], reverse=True)
+        genes = np.array([ e[2] for e in ranked ], dtype=np.int64)
+        codes = np.array([ e[3] for e in ranked ], dtype=np.int64)
+        scores = np.array([ e[0] for e in ranked ], dtype=np.float64)
+        selected[mode] = (vocabulary['genes'].values[genes], vocabulary['interactors'].values[codes], scores)
+    return selected
+
+def get_cache_entry(cache, folder, f):
+    # Entries are grouped by source folder, so the same gene file name in different folders never collides
+    folder_key = hashlib.sha1(os.path.abspath(folder).encode()).hexdigest()[:12]
+    entry = os.path.join(cache, folder_key, f.replace('.csv', ''))
+    return entry + '.npy', entry + '.json'
+
+def read_cached_gene_file(cache, folder, f):
+    # Return dictionary path and (code, score) rows from cache if entry exists for this exact source file
+    rows_file, info_file = get_cache_entry(cache, folder, f)
+    if not os.path.exists(info_file) or not os.path.exists(rows_file):
+        return None
+    stat = os.stat(folder + f)
+    with open(info_file) as fh:
+        info = json.load(fh)
+    if info['source'] != os.path.abspath(folder + f) or info['size'] != stat.st_size or info['mtime_ns'] != stat.st_mtime_ns:
+        return None
+    return os.path.join(os.path.dirname(rows_file), info['dictionary']), np.load(rows_file, mmap_mode='r')
+
+def write_cached_gene_file(cache, folder, f, interactors, scores):
+    # Dictionary encode interactor names, sorted so files listing the same interactors share one dictionary
+    rows_file, info_file = get_cache_entry(cache, folder, f)
+    os.makedirs(os.path.dirname(rows_file), exist_ok=True)
+    codes, names = pd.factorize(pd.Series(interactors, dtype=object).fillna(''), sort=True)
+    names = np.array(names, dtype=str)
+    dictionary = 'dictionary-%s.npy'%hashlib.sha1('\n'.join(names).encode()).hexdigest()[:16]
+    if not os.path.exists(os.path.join(os.path.dirname(rows_file), dictionary)):
+        save_atomic(os.path.join(os.path.dirname(rows_file), dictionary), names)
+    
+    # Keep scores as float32 unless that would merge distinct scores and change the ranking
+    scores = pd.to_numeric(pd.Series(scores), errors='coerce').values.astype(np.float64)
+    score_type = np.float32 if np.unique(scores.astype(np.float32)).shape[0] == np.unique(scores).shape[0] else np.float64
+    rows = np.empty(scores.shape[0], dtype=[('code', np.int32), ('score', score_type)])
+    rows['code'] = codes
+    rows['score'] = scores
+    
+    # Remove old info first, entry only counts as valid once its info is written
+    stat = os.stat(folder + f)
+    if os.path.exists(info_file):
+        os.remove(info_file)
+    save_atomic(rows_file, rows)
+    save_atomic(info_file, {'source': os.path.abspath(folder + f), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'dictionary': dictionary})
+
+def read_gene_file(folder, f, vocabulary, cache=None):
+    # Yield (interactor codes, scores) chunks of a gene file, from the binary cache when available
+    if cache is None:
+        for chunk in pd.read_csv(folder + f, chunksize=CHUNK_ROWS):
+            yield encode_interactors(vocabulary, chunk[chunk.columns[1]]), chunk[chunk.columns[-1]]
+        return
+    cached = read_cached_gene_file(cache, folder, f)
+    if cached is None:
+        df = pd.read_csv(folder + f)
+        write_cached_gene_file(cache, folder, f, df[df.columns[1]], df[df.columns[-1]])
+        cached = read_cached_gene_file(cache, folder, f)
+    dictionary, rows = cached
+    # Files sharing a dictionary are mapped to vocabulary codes once
+    if dictionary not in vocabulary['dictionaries']:
+        vocabulary['dictionaries'][dictionary] = encode_interactors(vocabulary, np.load(dictionary))
+    yield vocabulary['dictionaries'][dictionary][rows['code']], rows['score']
+
+def timed_chunks(chunks, stats):
+    # Pass chunks on, adding time spent reading them and rows read to stats
+    while True:
+        t_read = time.perf_counter()
+        chunk = next(chunks, None)
+        stats['read_seconds'] += time.perf_counter() - t_read
+        if chunk is None:
+            return
+        stats['rows'] += len(chunk[1])
+        yield chunk
+
+def get_top_interactors(f, tops, folder, prefix, cache=None):
+    # Get gene name from filename
+    gene = f.replace('.csv', '')
+    t_file = time.perf_counter()
+    stats = {'file': f, 'bytes': os.path.getsize(folder + f), 'rows': 0, 'rows_kept': {}, 'read_seconds': 0.0}
+    
+    # Read file in chunks, only the top interactors of each mode are kept in memory
+    vocabulary = get_vocabulary(prefix)
+    chunks = timed_chunks(read_gene_file(folder, f, vocabulary, cache=cache), stats)
+    selected = select_top_interactors(chunks, tops, vocabulary, stats=stats)
+    stats['seconds'] = time.perf_counter() - t_file
+    
+    # Only return what is needed for the result columns (keeps pickling to parent process small)
+    return gene, selected, stats
+
+def list_gene_files(folder):
+    # Names of .csv files in folder, one directory read without a stat call per file
+    with os.scandir(folder) as entries:
+        return [ e.name for e in entries if e.name.endswith('.csv') and e.is_file() ]
+
+def select_gene_files(filenames, prefix, mode):
+    # If only want to get non-Soy gene scores from files
+    if mode == 'pathogen_only':
+        return [ f for f in filenames if 'Glyma' in f ]
+    # If only want to get soy scores from files
+    elif mode == 'soy_only':
+        return [ f for f in filenames if prefix in f ]
+    # Get all gene files in folder
+    return [ f for f in filenames if 'Glyma' in f or prefix in f ]
+
+def parse_shard(text):
+    # --shard i/k, shard i (1 to k) of k
+    try:
+        shard, shards = [ int(i) for i in text.split('/') ]
+    except ValueError:
+        raise ValueError('--shard must be i/k, e.g. 1/4, not %s'%text)
+    if shards < 1 or not 1 <= shard <= shards:
+        raise ValueError('--shard i/k needs 1 <= i <= k, not %s'%text)
+    return shard, shards
+
+def get_shard(gene, shards, by='hash'):
+    # Shard (0 to shards - 1) of a gene, the same on every node and run
+    if by == 'chromosome':
+        # Soy genes by chromosome (scaffold genes with chromosome 0), others by hash
+        match = CHROMOSOME.match(gene)
+        if match is not None:
+            return (0 if match.group(1) == 'U' else int(match.group(1))) % shards
+    return int(hashlib.md5(gene.encode()).hexdigest(), 16) % shards
+
+def get_shard_result(filename, shard):
+    # Result file of one shard, merged into filename with --merge
+    stem, ext = os.path.splitext(filename)
+    return '%s_shard%sof%s%s'%(stem, shard[0], shard[1], ext)
+
+def find_shard_results(filename):
+    # Result files of all shards of filename, including any continued in after rollover
+    stem, ext = os.path.splitext(filename)
+    pattern = re.compile(re.escape(os.path.basename(stem)) + r'_shard\d+of\d+(_new)*' + re.escape(ext) + '$')
+    folder = os.path.dirname(filename) or '.'
+    with os.scandir(folder) as entries:
+        return sorted([ os.path.join(os.path.dirname(filename), e.name) for e in entries if pattern.match(e.name) ])
+
+def merge_shards(filename, interest=GENES_OF_INTEREST):
+    # Add gene columns of all shard results (and their isoform numbers) to filename
+    shard_results = find_shard_results(filename)
+    if len(shard_results) == 0:
+        print('%s: no shard results to merge...'%filename)
+        return
+    # A shard stopped between its two Excel writes has no isoform numbers file, its columns are left out of both files
+    complete = [ f for f in shard_results if os.path.exists(get_isoform_result(f)) ]
+    for f in shard_results:
+        if f not in complete:
+            print('%s has no %s, skipped (remove it and rerun its shard)'%(f, get_isoform_result(f)))
+    if len(complete) == 0:
+        return
+    shard_results = complete
+    # Continue in the file rolled over to if the result file is full
+    filename = get_saved_genes_sheet(filename)[2]
+    for result, shard_files in [(filename, shard_results), (get_isoform_result(filename), [ get_isoform_result(f) for f in shard_results ])]:
+        df = pd.concat([ read_excel_columns(f) for f in shard_files ], axis=1)
+        df = df[sorted(df.columns)]
+        print('Merging %s shard results into %s, %s gene columns...'%(len(shard_files), result, df.shape[1]))
+        write_to_excel(result, df, interest=interest)
+
+def get_job_result(filename, mode, top):
+    # Result file of one mode and number of top interactors when several are run together
+    stem, ext = os.path.splitext(filename)
+    return '%s_top%s%s%s'%(stem, top, '' if mode == 'all' else '_' + mode, ext)
+
+def get_isoform_result(filename):
+    # Excel with isoform numbers is saved next to result file
+    iso_filename = filename.split('.')
+    return ''.join(iso_filename[:-1]) + '_isoform_numbers.' + iso_filename[-1]
+
+def get_checkpoint_folder(filename):
+    # Completed gene columns not yet in the Excel result file are kept here
+    return os.path.splitext(filename)[0] + '_checkpoint'
+
+def write_checkpoint(folder, records, part):
+    # Each flush is a new part file, written whole or not at all
+    os.makedirs(folder, exist_ok=True)
+    save_atomic(os.path.join(folder, 'part-%s.jsonl'%part), ''.join([ json.dumps(r) + '\n' for r in records ]))
+
+def read_checkpoints(folder, top):
+    # Return {gene: record} from all flushed parts, ignoring records made with a different number of top interactors
+    records = {}
+    if not os.path.isdir(folder):
+        return records
+    for part in sorted(os.listdir(folder)):
+        if not part.endswith('.jsonl'):
+            continue
+        with open(os.path.join(folder, part)) as fh:
+            for line in fh:
+                record = json.loads(line)
+                if record['top'] == top:
+                    records[record['gene']] = record
+    return records
+
+def clear_checkpoints(folder):
+    # Once results are saved in Excel the checkpoints are no longer needed
+    if not os.path.isdir(folder):
+        return
+    for part in os.listdir(folder):
+        os.remove(os.path.join(folder, part))
+    os.rmdir(folder)
+
+def load_genes_of_interest(filename):
+    # One gene name per line (first column if comma or tab separated), blank lines and lines starting with '#' skipped
+    genes = []
+    with open(filename) as fh:
+        for line in fh:
+            gene = line.replace('\t', ',').split(',')[0].strip()
+            if gene and not gene.startswith('#'):
+                genes.append(gene)
+    return frozenset(genes)
+
+def build_result(records, top, interest=GENES_OF_INTEREST):
+    # Fill one (top + 1) x genes array per result in place, top interactors followed by % of top in genes of interest
+    genes = sorted(records)
+    rows = max([ len(records[g]['interactors']) for g in genes ], default=0) + 1
+    interactors = np.full((rows, len(genes)), np.nan, dtype=object)
+    interactor_isoforms = np.full((rows, len(genes)), np.nan, dtype=object)
+    for c, gene in enumerate(genes):
+        record = records[gene]
+        n = len(record['interactors'])
+        interactors[:n, c] = record['interactors']
+        interactor_isoforms[:n, c] = record['isoforms']
+    if len(genes) == 0:
+        return pd.DataFrame(), pd.DataFrame()
+    
+    # Count % of top interactors found in genes of interest, for all genes at once
+    percent_interested = ( pd.DataFrame(interactors).isin(interest).values.sum(axis=0) / top )*100
+    for c, gene in enumerate(genes):
+        n = len(records[gene]['interactors'])
+        interactors[n, c] = percent_interested[c]
+        interactor_isoforms[n, c] = percent_interested[c]
+    
+    return pd.DataFrame(data=interactors, columns=genes), pd.DataFrame(data=interactor_isoforms, columns=genes)
 
 # MAIN RUN
 if __name__ == '__main__':
+    args = parser.parse_args()
+    shard = None
+    if args.shard is not None:
+        try:
+            shard = parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
     t_start = time.time()
     # Show args for double-checking input
     print(args)
     
-    try:
+    # Timings are logged while running, summary (and profile) printed however the run ends
+    start_log(args.log if args.log is not None else os.path.splitext(args.result)[0] + '_log.jsonl', script='extract_top_genes.py', args=vars(args))
+    profiler = start_profile(args.profile)
+    atexit.register(summarize)
+    atexit.register(stop_profile, profiler, args.profile)
     
-        # If only want to get non-Soy gene scores from files
-        if args.pathogen_only:
-            files = np.array([ f for f in os.listdir(path=args.files) if '.csv' in f and 'Glyma' in f ])
-        # If only want to get soy scores from files
+    # One job per mode and number of top interactors, each with its own result files and checkpoints
+    jobs = []
+    # Matrix rows (gene, interactor genes, scores) not yet saved
+    matrix_rows = []
+    # Names part files of this run, shards running at the same time on other nodes never collide
+    run = '%d'%t_start if shard is None else '%d-shard%sof%s'%(t_start, shard[0], shard[1])
+    try:
+        
+        # Genes of interest to report % of in top interactors and highlight
+        interest = GENES_OF_INTEREST if args.interest is None else load_genes_of_interest(args.interest)
+        print('%s genes of interest'%len(interest))
+        
+        if args.modes is not None:
+            modes = args.modes
+        elif args.pathogen_only:
+            modes = ['pathogen_only']
         elif args.soy_only:
-            files = np.array([ f for f in os.listdir(path=args.files) if '.csv' in f and args.prefix in f ])
+            modes = ['soy_only']
         else:
-            # Get all gene files in folder
-            files = np.array([ f for f in os.listdir(path=args.files) if '.csv' in f and ('Glyma' in f or args.prefix in f) ])
-        print('\nNumber of gene files:', len(files))
+            modes = ['all']
         
-        # Skip any saved gene columns if exist already
-        saved_genes, sheetname = get_saved_genes_sheet(args.result)
-        print('%s genes already saved'%saved_genes.shape[0])
+        if args.merge:
+            # Add results of all shards to the result files
+            with stage('merge_shards'):
+                for mode in modes:
+                    for top in args.top:
+                        merge_shards(args.result if len(modes) * len(args.top) == 1 else get_job_result(args.result, mode, top), interest=interest)
+            if args.matrix is not None:
+                print('Building interaction matrix...')
+                with stage('matrix'):
+                    build_matrix(args.matrix)
+            print('Done!\n')
+            exit()
         
+        with stage('file_discovery') as fields:
+            filenames = list_gene_files(args.files)
+            fields['files'] = len(filenames)
         if not args.all:
             print('Getting longest sequenced isoforms...')
-            seq = pd.read_csv(args.sequences, sep='\n', header=None)
-            isoforms, many_longest = get_isoforms(seq)
+            with stage('isoform_selection'):
+                isoforms, many_longest = get_isoforms(args.sequences, index_folder=args.cache)
             print('\t%s relevant gene isoforms\n\t%s have multiple equally long sequences...'%(isoforms.shape[0], isoforms[isoforms.isin(many_longest)].shape[0]))
-            # Only process gene files for relevant isoforms
-            #files = np.array([ i for i in files if i.replace('.csv', '' ) in isoforms.values or i.replace('.csv', '' ) in many_longest.values ])
-            files = np.array([ i for i in files if i.replace('.csv', '' ) in isoforms.values and i.replace('.csv', '' ) not in saved_genes ])
-            print('\n%s relevant files to process...\n'%len(files))
+            relevant = set(isoforms.values)
+        
+        # Gene files of every mode after isoform and shard selection
+        relevant_files = set()
+        for mode in modes:
+            files = select_gene_files(filenames, args.prefix, mode)
+            print('\n%s: number of gene files: %s'%(mode, len(files)))
+            if not args.all:
+                # Only process gene files for relevant isoforms
+                files = [ i for i in files if i.replace('.csv', '' ) in relevant ]
+            if shard is not None:
+                # Only process gene files of this shard
+                files = [ i for i in files if get_shard(i.replace('.csv', ''), shard[1], by=args.shard_by) == shard[0] - 1 ]
+                print('%s gene files in shard %s/%s'%(len(files), shard[0], shard[1]))
+            relevant_files.update([ i.replace('.csv', '') for i in files ])
+            
+            for top in args.top:
+                job = {'mode': mode, 'top': top, 'pending': []}
+                job['result'] = args.result if len(modes) * len(args.top) == 1 else get_job_result(args.result, mode, top)
+                with stage('resume_scan', result=job['result']):
+                    merged_genes = []
+                    if shard is not None:
+                        # Genes merged from earlier shard runs are skipped too
+                        merged_genes = get_saved_genes_sheet(job['result'])[0]
+                        job['result'] = get_shard_result(job['result'], shard)
+                    
+                    # Skip any saved gene columns if exist already
+                    saved_genes, sheetname, job['result'] = get_saved_genes_sheet(job['result'])
+                    print('%s: %s genes already saved'%(job['result'], saved_genes.shape[0] + len(merged_genes)))
+                    saved_genes = set(saved_genes) | set(merged_genes) if not args.all else set()
+                    
+                    # Skip genes completed by a previous run that stopped before writing Excel
+                    job['checkpoint_folder'] = get_checkpoint_folder(job['result'])
+                    checkpointed = read_checkpoints(job['checkpoint_folder'], top)
+                if len(checkpointed) > 0:
+                    print('%s genes recovered from checkpoints'%len(checkpointed))
+                job['genes'] = set([ i.replace('.csv', '') for i in files if i.replace('.csv', '') not in saved_genes and i.replace('.csv', '') not in checkpointed ])
+                print('%s relevant files to process...'%len(job['genes']))
+                jobs.append(job)
+        
+        # Genes already in the results (or checkpoints) are still read if the matrix has no row for them yet
+        matrix_genes = set()
+        if args.matrix is not None:
+            matrix_genes = relevant_files - get_matrix_files(args.matrix) - set([ g for job in jobs for g in job['genes'] ])
+            print('%s more files to read for matrix %s'%(len(matrix_genes), args.matrix))
         
-        # For result file
-        final = pd.DataFrame()
-        final_isoforms = pd.DataFrame()
+        # Each file is read once, ranked up to the largest number of top interactors needed for each mode
+        files = sorted(set([ g for job in jobs for g in job['genes'] ]) | matrix_genes)
+        file_tops = []
+        for gene in files:
+            tops = {}
+            for job in jobs:
+                if gene in job['genes']:
+                    tops[job['mode']] = max(tops.get(job['mode'], 0), job['top'])
+            if args.matrix is not None:
+                # Matrix keeps soy and pathogen interactors, the ranking of mode all
+                tops['all'] = max(tops.get('all', 0), args.matrix_top)
+            file_tops.append(tops)
+        files = [ g + '.csv' for g in files ]
         
         # Iterate through each file
-        print('\nIterating through files...')
-        for f in tqdm.tqdm(files):
-    
-            # Get gene name from filename
-            gene = f.replace('.csv', '')
-            
-            # Read file
-            df = pd.read_csv(args.files + f)
-            
-            # Remove any genes that are not SOY or pathogen
-            df = df[(df[df.columns[1]].str.contains('Glyma')) | (df[df.columns[1]].str.contains(args.prefix))]
-            df.reset_index(drop=True, inplace=True)
-            
-            # If only want to consider non-Soy genes for interactor scores
-            if args.pathogen_only:
-                df = df[df[df.columns[1]].str.contains(args.prefix)]
-                df.reset_index(drop=True, inplace=True)
-            if args.soy_only:
-                df = df[df[df.columns[1]].str.contains('Glyma')]
-                df.reset_index(drop=True, inplace=True)
-            
-            # Sort by scores in descending order
-            df.sort_values(by=df.columns[-1], ascending=False, inplace=True)
-            df.reset_index(drop=True, inplace=True)
-            
-            # Keep copy for recording interactor isoform number
-            df_isoforms = df.copy()
-            # Remove gene isoform number (after the last '.')
-            df[df.columns[1]] = [ '.'.join(g[:-1]) for g in df[df.columns[1]].str.split('.').values ]
-            
-            # Drop any duplicated interactor genes from list (removes isoform variants, keeping the top scored one)
-            df = df.drop_duplicates(subset=[df.columns[1]])
-            
-            # Re-sort non-duplicated genes
-            df.sort_values(by=df.columns[-1], ascending=False, inplace=True)
+        print('\nIterating through %s files...'%len(files))
+        t_files = time.perf_counter()
+        extract = partial(get_top_interactors, folder=args.files, prefix=args.prefix, cache=args.cache)
+        if args.workers > 1:
+            # Spread files over processes, results come back in the same order as files
+            executor = ProcessPoolExecutor(max_workers=args.workers)
+            results = executor.map(extract, files, file_tops, chunksize=max(1, len(files) // (args.workers * 16)))
+        else:
+            executor = None
+            results = map(extract, files, file_tops)
+        part = 0
+        last_flush = time.time()
+        totals = {'bytes': 0, 'rows': 0, 'read_seconds': 0.0}
+        for gene, selected, stats in tqdm.tqdm(results, total=len(files)):
+            # Time of each file is measured in the process that read it
+            for key in totals:
+                totals[key] += stats[key]
+            log_file(stats.pop('file'), stats.pop('seconds'), **stats)
             
-            # Get top interactors
-            df = df.iloc[:args.top]
-            df_isoforms = df_isoforms.iloc[df.index]
+            # Smaller numbers of top interactors are the start of the ranking for the largest
+            for job in jobs:
+                if gene in job['genes']:
+                    interactors, interactor_isoforms, scores = selected[job['mode']]
+                    job['pending'].append({'gene': gene, 'top': job['top'], 'interactors': list(interactors[:job['top']]), 
+                                           'isoforms': list(interactor_isoforms[:job['top']])})
+            if args.matrix is not None:
+                interactors, interactor_isoforms, scores = selected['all']
+                exported = np.isfinite(scores[:args.matrix_top])
+                matrix_rows.append((gene, interactors[:args.matrix_top][exported], scores[:args.matrix_top][exported]))
             
-            df.reset_index(drop=True, inplace=True)
-            df_isoforms.reset_index(drop=True, inplace=True)
-
-            # Count % of top interactors found in genes of interest
-            percent_interested = ( df[df.columns[1]].isin(GENES_OF_INTEREST).sum() / args.top )*100
+            # Periodically save completed genes so a crash or interrupt loses little work
+            if max([ len(job['pending']) for job in jobs ] + [len(matrix_rows)]) >= args.checkpoint_every or time.time() - last_flush >= args.checkpoint_seconds:
+                part += 1
+                with stage('checkpoint', part=part):
+                    for job in jobs:
+                        if len(job['pending']) > 0:
+                            write_checkpoint(job['checkpoint_folder'], job['pending'], '%s-%06d'%(run, part))
+                            job['pending'] = []
+                    if len(matrix_rows) > 0:
+                        write_matrix_part(args.matrix, matrix_rows, '%s-%06d'%(run, part))
+                        matrix_rows = []
+                last_flush = time.time()
+        part += 1
+        with stage('checkpoint', part=part):
+            for job in jobs:
+                if len(job['pending']) > 0:
+                    write_checkpoint(job['checkpoint_folder'], job['pending'], '%s-%06d'%(run, part))
+                    job['pending'] = []
+            if len(matrix_rows) > 0:
+                write_matrix_part(args.matrix, matrix_rows, '%s-%06d'%(run, part))
+                matrix_rows = []
+        if executor is not None:
+            executor.shutdown()
+        # Reading is summed over files (over processes with -w), the rest of the stage is ranking and checkpoints
+        log_stage('top_interactors', time.perf_counter() - t_files, files=len(files), workers=args.workers, **totals)
+        
+        for job in jobs:
+            # Build result from all checkpointed genes, including those of previous runs
+            with stage('result_assembly', result=job['result']):
+                final, final_isoforms = build_result(read_checkpoints(job['checkpoint_folder'], job['top']), job['top'], interest=interest)
             
-            # Create column for gene and include % of top in genes of interest
-            gene_info = pd.DataFrame(data=df[df.columns[1]].values, columns=[gene])
-            gene_info_isoforms = pd.DataFrame(data=df_isoforms[df_isoforms.columns[1]].values, columns=[gene])
+            if final.empty:
+                print('%s: no columns to add...'%job['result'])
+                continue
             
-            gene_info = gene_info[gene].append(pd.Series(percent_interested), ignore_index=True)
-            gene_info_isoforms = gene_info_isoforms[gene].append(pd.Series(percent_interested), ignore_index=True)
+            # Write to excel
+            print('Creating coloured Excel %s, %s gene columns...'%(job['result'], final.shape[1]))
+            with stage('excel_writing', result=job['result'], columns=final.shape[1]):
+                write_to_excel(job['result'], final, interest=interest)
             
-            gene_info = pd.DataFrame(gene_info, columns=[gene])
-            gene_info_isoforms = pd.DataFrame(gene_info_isoforms, columns=[gene])
-    
-            #Add gene info to final
-            final.insert(len(final.columns), gene, gene_info[gene])
-            final_isoforms.insert(len(final_isoforms.columns), gene, gene_info_isoforms[gene])
+            print('Creating Excel with isoform numbers, %s gene columns...'%final_isoforms.shape[1])
+            with stage('excel_writing', result=get_isoform_result(job['result']), columns=final_isoforms.shape[1]):
+                write_to_excel(get_isoform_result(job['result']), final_isoforms, interest=interest)
+            clear_checkpoints(job['checkpoint_folder'])
         
-        final = final[sorted(final.columns)]
-        final_isoforms = final_isoforms[sorted(final_isoforms.columns)]
-        show_duration(t_start)
-        
-        if final.empty:
-            print('No columns to add...\nDone!\n')
-            show_duration(t_start)
-            exit()
-        
-        # Write to excel
-        print('Creating coloured Excel, %s gene columns...'%final.shape[1])
-        write_to_excel(args.result, final)
-        
-        show_duration(t_start)
-        
-        print('Creating Excel with isoform numbers, %s gene columns...'%final_isoforms.shape[1])
-        iso_filename = args.result.split('.')
-        iso_filename = ''.join(iso_filename[:-1]) + '_isoform_numbers.' + iso_filename[-1]
-        write_to_excel(iso_filename, final_isoforms)
+        if args.matrix is not None and shard is None:
+            print('Building interaction matrix...')
+            with stage('matrix'):
+                build_matrix(args.matrix)
         
         print('Done!\n')
-        show_duration(t_start)
     except (KeyboardInterrupt, Exception):
-        atexit.register(show_duration, t_start)
+        # Keep genes completed since last checkpoint
+        for job in jobs:
+            if len(job['pending']) > 0:
+                write_checkpoint(job['checkpoint_folder'], job['pending'], '%s-interrupted'%run)
+                print('Saved %s completed genes to %s'%(len(job['pending']), job['checkpoint_folder']))
+        if len(matrix_rows) > 0:
+            write_matrix_part(args.matrix, matrix_rows, '%s-interrupted'%run)
         traceback.print_exc()
-    
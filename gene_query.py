@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Description:
+    Query top interactors saved by extract_top_genes.py without opening the Excel files
+    1. Load result workbooks (and their _isoform_numbers companions) once into an indexed SQLite database
+        i) One row per gene column (gene, chromosome, number of top interactors, % of top in genes of interest)
+        ii) One row per top interactor (rank, interactor gene, isoform, whether it is a gene of interest)
+        iii) Rerunning only reloads result files added or changed since
+    2. Answer queries from the command line or from a HTTP server on localhost, recent queries are kept in an LRU cache
+        gene: top interactors of a gene (gene name or gene file name with isoform number)
+        chromosome: genes of a soy chromosome (1 to 20 or U) with their %
+        percent: genes whose % of top in genes of interest is within low:high (50: for at least 50, :10 for at most 10)
+        partner: genes having the interactor in their top interactors, with its rank
+
+Usage:
+    python gene_query.py -d <path_to_database.sqlite> -b <path_to_result.xlsx> [<path_to_result.xlsx> ...] -q <query> -v <value> [<value> ...]
+
+        e.g.
+        python gene_query.py -d soy.sqlite -b Documents/SOY/soy_top40.xlsx Documents/SOY/soy_top20_pathogen_only.xlsx
+        python gene_query.py -d soy.sqlite -q gene -v Glyma.18G022500 -k 40 -result soy_top40
+        python gene_query.py -d soy.sqlite -q percent -v 50:100
+
+        Results are named by their file name (soy_top40 for soy_top40.xlsx), files rolled over to (_new.xlsx) are loaded with them
+        Results with the same file name in different folders are named by their path from the shared folder (soy_soy/top, soy_pathogen/top),
+        or name them with -b <name>=<path_to_result.xlsx>
+        Add -i <path_to_genes_file> when building to mark another list of genes of interest (same as extract_top_genes.py -i)
+
+        Add -serve <port> to answer queries over HTTP on localhost as JSON, e.g.
+        python gene_query.py -d soy.sqlite -serve 8000
+        curl 'http://127.0.0.1:8000/gene/Glyma.18G022500?result=soy_top40&top=40'
+        curl 'http://127.0.0.1:8000/partner/Hetgly.g00012'
+        curl 'http://127.0.0.1:8000/results'
+"""
+
+import os
+import json
+import time
+import sqlite3
+import argparse
+import threading
+from functools import lru_cache
+from urllib.parse import urlparse, parse_qs, unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pandas as pd
+import tqdm
+from extract_top_genes import GENES_OF_INTEREST, CHROMOSOME, load_genes_of_interest, read_manifest, read_excel_columns, get_isoform_result
+from interaction_matrix import get_gene
+
+# Tables are clustered by their primary key, lookups of one gene read neighbouring pages only
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sources (path TEXT PRIMARY KEY, result TEXT, size INTEGER, mtime_ns INTEGER);
+CREATE TABLE IF NOT EXISTS genes (result TEXT, query TEXT, gene TEXT, chromosome TEXT, top INTEGER, percent REAL,
+                                  PRIMARY KEY (result, query)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS interactors (result TEXT, query TEXT, rank INTEGER, interactor TEXT, isoform TEXT, interest INTEGER,
+                                        PRIMARY KEY (result, query, rank)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS genes_gene ON genes (gene);
+CREATE INDEX IF NOT EXISTS genes_query ON genes (query);
+CREATE INDEX IF NOT EXISTS genes_chromosome ON genes (chromosome, result);
+CREATE INDEX IF NOT EXISTS genes_percent ON genes (percent);
+CREATE INDEX IF NOT EXISTS interactors_interactor ON interactors (interactor);
+CREATE INDEX IF NOT EXISTS interactors_isoform ON interactors (isoform);
+'''
+# SQL of each query, {result} and {top} are filled with the optional filters
+QUERIES = {
+    'gene': '''SELECT g.result, g.query, i.rank, i.interactor, i.isoform, i.interest, g.percent
+               FROM genes g JOIN interactors i ON i.result = g.result AND i.query = g.query
+               WHERE (g.gene = :value OR g.query = :value) {result} {top}
+               ORDER BY g.result, g.query, i.rank''',
+    'chromosome': '''SELECT g.result, g.query, g.top, g.percent FROM genes g
+                     WHERE g.chromosome = :value {result} ORDER BY g.result, g.query''',
+    'percent': '''SELECT g.result, g.query, g.top, g.percent FROM genes g
+                  WHERE g.percent BETWEEN :low AND :high {result} ORDER BY g.percent DESC, g.result, g.query''',
+    'partner': '''SELECT i.result, i.query, i.rank, i.isoform, g.percent
+                  FROM interactors i JOIN genes g ON g.result = i.result AND g.query = i.query
+                  WHERE (i.interactor = :value OR i.isoform = :value) {result} {top}
+                  ORDER BY i.result, i.rank, i.query''',
+    }
+# Most recent queries kept in memory
+CACHE_SIZE = 4096
+
+def get_result_names(builds):
+    # Returns [(name, filename), ...] from <filename> or <name>=<filename>, file names repeated in different folders
+    # are named by their path relative to the folder all of them share
+    named = [ b.partition('=')[::2] if '=' in b else (None, b) for b in builds ]
+    stems = [ os.path.splitext(os.path.basename(f))[0] for n, f in named ]
+    if len(set(stems)) < len(stems):
+        common = os.path.commonpath([ os.path.abspath(f) for n, f in named ])
+        stems = [ os.path.splitext(os.path.relpath(os.path.abspath(f), common))[0].replace(os.sep, '/') for n, f in named ]
+    names = [ (n if n is not None else stem, f) for (n, f), stem in zip(named, stems) ]
+    repeated = sorted(set([ n for n, f in names if [ m for m, g in names ].count(n) > 1 ]))
+    if len(repeated) > 0:
+        raise ValueError('Result names must be different, %s given more than once (name them with <name>=<path>)'%', '.join(repeated))
+    return names
+
+def get_result_files(filename):
+    # Result file followed by the files it rolled over to (recorded in the manifest by extract_top_genes.py)
+    files = []
+    while filename is not None and os.path.exists(filename) and filename not in files:
+        files.append(filename)
+        saved = read_manifest(filename)
+        filename = saved[0]['rollover'] if saved is not None else None
+    return files
+
+def get_chromosome(gene):
+    # '01' ... '20' or 'U' for soy genes, None otherwise
+    match = CHROMOSOME.match(gene)
+    return match.group(1) if match is not None else None
+
+def parse_chromosome(value):
+    # Accept 8, 08, U or Glyma.08
+    value = str(value).replace('Glyma.', '').upper()
+    return value if value == 'U' else value.zfill(2)
+
+def connect(database, read_only=False):
+    # Connections may be shared by server threads, queries are serialized by the caller
+    if read_only:
+        connection = sqlite3.connect('file:%s?mode=ro'%os.path.abspath(database), uri=True, check_same_thread=False)
+    else:
+        connection = sqlite3.connect(database, check_same_thread=False)
+        connection.executescript(SCHEMA)
+    return connection
+
+def get_rows(result, interactors, isoforms, interest):
+    # Gene and interactor rows of one result, each column is top interactors followed by % of top in genes of interest
+    genes, ranked = [], []
+    for query in interactors.columns:
+        values = interactors[query].dropna().tolist()
+        if len(values) == 0:
+            continue
+        percent = values.pop()
+        names = isoforms[query].tolist()[:len(values)] if query in isoforms.columns else [None] * len(values)
+        genes.append((result, query, get_gene(query), get_chromosome(query), len(values), float(percent)))
+        for rank, (interactor, isoform) in enumerate(zip(values, names), start=1):
+            ranked.append((result, query, rank, interactor, isoform, int(interactor in interest)))
+    return genes, ranked
+
+def load_results(connection, builds, interest=GENES_OF_INTEREST):
+    # (Re)load results whose files were added or changed, returns names of results loaded
+    saved = dict(( (path, (size, mtime_ns, result)) for path, size, mtime_ns, result in connection.execute('SELECT path, size, mtime_ns, result FROM sources') ))
+    loaded = []
+    for result, filename in tqdm.tqdm(get_result_names(builds)):
+        files = get_result_files(filename)
+        if len(files) == 0:
+            print('%s not found...'%filename)
+            continue
+        files = files + [ get_isoform_result(f) for f in files if os.path.exists(get_isoform_result(f)) ]
+        sources = dict(( (os.path.abspath(f), (os.stat(f).st_size, os.stat(f).st_mtime_ns)) for f in files ))
+        if all([ saved.get(path) == stamp + (result,) for path, stamp in sources.items() ]):
+            continue
+        # A name belongs to one result file, loading another file under it would silently replace that result
+        owners = set([ path for path, (size, mtime_ns, name) in saved.items() if name == result ])
+        if len(owners) > 0 and len(owners & set(sources)) == 0:
+            raise ValueError('Result %s is already loaded from %s, name %s another way with <name>=%s'%(result, sorted(owners)[0], filename, filename))
+
+        # Columns of rollover files are added to those of the result file
+        interactors = pd.concat([ read_excel_columns(f) for f in get_result_files(filename) ], axis=1)
+        isoforms = [ read_excel_columns(get_isoform_result(f)) for f in get_result_files(filename) if os.path.exists(get_isoform_result(f)) ]
+        isoforms = pd.concat(isoforms, axis=1) if len(isoforms) > 0 else pd.DataFrame()
+        genes, ranked = get_rows(result, interactors, isoforms, interest)
+
+        # Whole result is replaced in one transaction, queries never see half a result
+        # Results loaded before from the same files (e.g. under another name) are replaced too
+        replaced = set([ result ] + [ saved[path][2] for path in sources if path in saved ])
+        with connection:
+            for name in replaced:
+                connection.execute('DELETE FROM genes WHERE result = ?', (name,))
+                connection.execute('DELETE FROM interactors WHERE result = ?', (name,))
+                connection.execute('DELETE FROM sources WHERE result = ?', (name,))
+            connection.executemany('DELETE FROM sources WHERE path = ?', [ (path,) for path in sources ])
+            connection.executemany('INSERT INTO genes VALUES (?, ?, ?, ?, ?, ?)', genes)
+            connection.executemany('INSERT INTO interactors VALUES (?, ?, ?, ?, ?, ?)', ranked)
+            connection.executemany('INSERT INTO sources VALUES (?, ?, ?, ?)', [ (path, result, size, mtime_ns) for path, (size, mtime_ns) in sources.items() ])
+        print('%s: %s genes, %s interactors'%(result, len(genes), len(ranked)))
+        loaded.append(result)
+    connection.execute('ANALYZE')
+    return loaded
+
+def run_query(connection, query, value=None, result=None, top=None):
+    # Returns (columns, rows) of one query, rows as tuples
+    if query == 'results':
+        cursor = connection.execute('SELECT result, COUNT(*) AS genes, MAX(top) AS top, AVG(percent) AS mean_percent FROM genes GROUP BY result ORDER BY result')
+        return [ c[0] for c in cursor.description ], tuple(cursor.fetchall())
+    parameters = {'value': value, 'result': result, 'top': top}
+    if query == 'chromosome':
+        parameters['value'] = parse_chromosome(value)
+    if query == 'percent':
+        # 50:100, 50: (at least 50) or :10 (at most 10)
+        low, _, high = str(value).partition(':')
+        parameters['low'] = float(low) if low != '' else 0
+        parameters['high'] = float(high) if high != '' else 100
+    sql = QUERIES[query].format(result='AND g.result = :result' if result is not None else '',
+                                top='AND i.rank <= :top' if top is not None else '')
+    cursor = connection.execute(sql, parameters)
+    return [ c[0] for c in cursor.description ], tuple(cursor.fetchall())
+
+def cached_queries(connection, size=CACHE_SIZE):
+    # Same queries are answered from memory, the lock lets server threads share the connection
+    lock = threading.Lock()
+    @lru_cache(maxsize=size)
+    def query(name, value=None, result=None, top=None):
+        with lock:
+            return run_query(connection, name, value, result=result, top=top)
+    return query
+
+def serve(query, port):
+    # GET /<query>/<value>?result=<result>&top=<top> and /results, answered as JSON
+    class QueryHandler(BaseHTTPRequestHandler):
+        def send_json(self, status, data):
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            parts = [ unquote(p) for p in url.path.strip('/').split('/') ]
+            options = dict(( (k, v[-1]) for k, v in parse_qs(url.query).items() ))
+            t_query = time.perf_counter()
+            try:
+                if parts == ['results']:
+                    columns, rows = query('results')
+                elif len(parts) == 2 and parts[0] in QUERIES:
+                    columns, rows = query(parts[0], parts[1], result=options.get('result'), top=int(options['top']) if 'top' in options else None)
+                else:
+                    self.send_json(404, {'error': 'Unknown path %s, use /<%s>/<value> or /results'%(url.path, '|'.join(QUERIES))})
+                    return
+            except ValueError as e:
+                self.send_json(400, {'error': str(e)})
+                return
+            self.send_json(200, {'columns': columns, 'rows': rows, 'milliseconds': (time.perf_counter() - t_query) * 1000})
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), QueryHandler)
+    print('Serving queries on http://127.0.0.1:%s/ (Ctrl+C to stop)...'%port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+# MAIN RUN
+if __name__ == '__main__':
+    # DEFINE COMMANDLINE ARGUMENTS
+    describe_help = 'python gene_query.py -d soy.sqlite -b soy_top40.xlsx -q gene -v Glyma.18G022500'
+    parser = argparse.ArgumentParser(description=describe_help)
+    parser.add_argument('-d', '--database', help='Full path to SQLite database file, created if it does not exist', type=str, default=os.getcwd() + '/top_genes.sqlite')
+    parser.add_argument('-b', '--build', help='Result Excel file(s) from extract_top_genes.py to load, as <path> or <name>=<path> (only new or changed files are reloaded)', type=str, nargs='+', default=[])
+    parser.add_argument('-i', '--interest', help='File of genes of interest, one gene per line (default is GENES_OF_INTEREST)', type=str, default=None)
+    parser.add_argument('-q', '--query', help='Query type', type=str, choices=list(QUERIES) + ['results'], default='results')
+    parser.add_argument('-v', '--values', help='Gene(s), chromosome(s), low:high % range(s) or partner(s) to query', type=str, nargs='+', default=[])
+    parser.add_argument('-result', '--result', help='Only query this result (file name without .xlsx, e.g. soy_top40)', type=str, default=None)
+    parser.add_argument('-k', '--top', help='Only return interactors ranked up to this (gene and partner queries)', type=int, default=None)
+    parser.add_argument('-o', '--output', help='Full path to .csv file for query results', type=str, default=None)
+    parser.add_argument('-serve', '--serve', help='Port to answer queries on over HTTP on localhost', type=int, default=None)
+    args = parser.parse_args()
+
+    if len(args.build) > 0:
+        interest = GENES_OF_INTEREST if args.interest is None else load_genes_of_interest(args.interest)
+        connection = connect(args.database)
+        try:
+            load_results(connection, args.build, interest=interest)
+        except ValueError as e:
+            parser.error(str(e))
+        connection.close()
+
+    connection = connect(args.database, read_only=True)
+    query = cached_queries(connection)
+    if args.serve is not None:
+        serve(query, args.serve)
+    elif args.query == 'results':
+        columns, rows = query('results')
+        print(pd.DataFrame(list(rows), columns=columns).to_string(index=False))
+    else:
+        results = []
+        for value in args.values:
+            t_query = time.perf_counter()
+            try:
+                columns, rows = query(args.query, value, result=args.result, top=args.top)
+            except ValueError as e:
+                # Same message as the HTTP 400 answer
+                print('\n%s %s: %s'%(args.query, value, e))
+                continue
+            result = pd.DataFrame(list(rows), columns=columns)
+            print('\n%s %s: %s rows in %.1f ms\n%s'%(args.query, value, result.shape[0], (time.perf_counter() - t_query) * 1000, result.to_string(index=False)))
+            result.insert(0, 'value', value)
+            results.append(result)
+        if args.output is not None and len(results) > 0:
+            pd.concat(results).to_csv(args.output, index=False)
+    connection.close()
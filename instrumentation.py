@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Description:
+    Timings, sizes and memory of a run, used by extract_top_genes.py and organize_gene_results_all_analysis.py
+        i) Stages (e.g. isoform selection, top interactors, Excel writing) and files (bytes, rows, rows kept by filters,
+           seconds reading vs ranking) are written as JSON lines to a log file while running
+        ii) A summary of total time, slowest stages and slowest files is printed and logged at the end
+        iii) Optionally the run is profiled with cProfile, stats are saved for pstats/snakeviz
+
+    Log lines look like:
+        {"event": "stage", "stage": "excel_writing", "seconds": 12.3, "peak_rss_mb": 812.5, "time": 1700000000.0, ...}
+        {"event": "file", "file": "Glyma.01G000100.1.csv", "seconds": 0.4, "read_seconds": 0.3, "bytes": 2300000, "rows": 90000, ...}
+"""
+
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import resource
+from contextlib import contextmanager
+
+# State of the run in this process
+LOG = {'file': None, 't_start': None, 'stages': {}, 'files': []}
+# Number of slowest stages and files in summary
+SUMMARY_TOP = 10
+
+def peak_rss_mb():
+    # Peak resident memory of this process and finished child processes (Linux reports KB, macOS bytes)
+    scale = 1 / 1024 if sys.platform != 'darwin' else 1 / 1024 / 1024
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * scale
+
+def start_log(filename, **fields):
+    # Log lines are appended, so reruns of the same command keep earlier runs
+    LOG['t_start'] = time.time()
+    LOG['stages'] = {}
+    LOG['files'] = []
+    if filename is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        LOG['file'] = open(filename, 'a')
+    log_event('start', **fields)
+
+def log_event(event, **fields):
+    fields = dict(event=event, time=time.time(), **fields)
+    if LOG['file'] is not None:
+        LOG['file'].write(json.dumps(fields, default=str) + '\n')
+        LOG['file'].flush()
+    return fields
+
+def log_stage(name, seconds, **fields):
+    # Totals are kept for stages run several times (e.g. once per result file)
+    total = LOG['stages'].setdefault(name, {'seconds': 0, 'count': 0})
+    total['seconds'] += seconds
+    total['count'] += 1
+    log_event('stage', stage=name, seconds=seconds, peak_rss_mb=peak_rss_mb(), **fields)
+
+@contextmanager
+def stage(name, **fields):
+    # Time a block of the run, fields added to the yielded dict inside the block are logged too
+    t_start = time.perf_counter()
+    try:
+        yield fields
+    finally:
+        log_stage(name, time.perf_counter() - t_start, **fields)
+
+def log_file(name, seconds, **fields):
+    # One processed input file, e.g. bytes, rows parsed and rows kept
+    LOG['files'].append((seconds, name))
+    log_event('file', file=name, seconds=seconds, **fields)
+
+def summarize():
+    # Print and log total time, slowest stages and files
+    total = time.time() - LOG['t_start'] if LOG['t_start'] is not None else 0
+    stages = sorted(LOG['stages'].items(), key=lambda s: s[1]['seconds'], reverse=True)[:SUMMARY_TOP]
+    files = sorted(LOG['files'], reverse=True)[:SUMMARY_TOP]
+    print('\nTotal %.1f s (%.2f h), peak memory %.0f MB'%(total, total / 3600, peak_rss_mb()))
+    if len(stages) > 0:
+        print('Slowest stages:')
+        for name, s in stages:
+            print('\t%-28s %10.2f s  (%s%%)'%(name if s['count'] == 1 else '%s (x%s)'%(name, s['count']), s['seconds'], round(s['seconds'] / max(total, 1e-9) * 100, 1)))
+    if len(files) > 0:
+        print('Slowest files (of %s):'%len(LOG['files']))
+        for seconds, name in files:
+            print('\t%-40s %10.3f s'%(name, seconds))
+    log_event('summary', seconds=total, peak_rss_mb=peak_rss_mb(), files=len(LOG['files']),
+              stages=dict(LOG['stages']), slowest_files=[ {'file': name, 'seconds': seconds} for seconds, name in files ])
+    if LOG['file'] is not None:
+        LOG['file'].close()
+        LOG['file'] = None
+
+def start_profile(filename):
+    # Profile the rest of the run with cProfile if filename is given (only this process, not worker processes)
+    if filename is None:
+        return None
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def stop_profile(profiler, filename):
+    # Save stats to filename (open with pstats or snakeviz) and print top functions
+    if profiler is None:
+        return
+    profiler.disable()
+    profiler.dump_stats(filename)
+    print('\nProfile saved to %s, top functions by cumulative time:'%filename)
+    pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Description:
+    Sparse matrix of interaction scores exported by extract_top_genes.py (-x <matrix_folder/>)
+        i) Rows are gene files, columns are interactor genes, both indexed by one gene vocabulary (isoform number removed)
+        ii) Saved as CSR (each row ordered by score) and CSC (each column ordered by score) .npy arrays, memory-mapped when loaded
+    Queries:
+        row: top k interactors of a gene
+        column: top k genes scoring a gene as interactor, with the rank it has in each of their rows
+        reciprocal: interactors of a gene that also have the gene in their own top k
+
+Usage:
+    python interaction_matrix.py -m <PATH_TO_MATRIX_FOLDER/> -g <gene> [<gene> ...] -q <row|column|reciprocal> -k <number_of_top>
+
+        e.g.
+        python interaction_matrix.py -m Documents/SOY/matrix/ -g Glyma.18G022500 -q column -k 20
+
+        Add -b to (re)build the matrix from the parts saved while extract_top_genes.py was running (e.g. after an interrupted run)
+"""
+
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+
+# Arrays of the matrix, each saved as <name>.npy in the matrix folder
+CSR_ARRAYS = ('csr_indptr', 'csr_indices', 'csr_data')
+CSC_ARRAYS = ('csc_indptr', 'csc_indices', 'csc_data', 'csc_ranks')
+
+def get_gene(name):
+    # Remove isoform number, same as interactor names in extract_top_genes.py
+    return name.rpartition('.')[0]
+
+def get_parts_folder(folder):
+    return os.path.join(folder, 'parts')
+
+def save_atomic(path, data):
+    # Write to a temporary file and rename so a crash never leaves a half written file
+    # Text as is, .json as JSON, .npz as named arrays (dictionary), anything else as one .npy array
+    tmp = '%s.%s.tmp'%(path, os.getpid())
+    if isinstance(data, str):
+        with open(tmp, 'w') as fh:
+            fh.write(data)
+    elif path.endswith('.json'):
+        with open(tmp, 'w') as fh:
+            json.dump(data, fh)
+    elif path.endswith('.npz'):
+        with open(tmp, 'wb') as fh:
+            np.savez(fh, **data)
+    else:
+        with open(tmp, 'wb') as fh:
+            np.save(fh, data)
+    os.replace(tmp, path)
+
+def save_part(folder, part, files, indptr, names, codes, scores):
+    # Interactors are saved as codes into the part's own table of names, a few bytes per entry instead of a string
+    os.makedirs(get_parts_folder(folder), exist_ok=True)
+    data = {
+        'files': np.asarray(files, dtype=str),
+        'indptr': np.asarray(indptr, dtype=np.int64),
+        'names': np.asarray(names, dtype=str),
+        'codes': np.asarray(codes, dtype=np.int32),
+        'scores': np.asarray(scores, dtype=np.float32),
+        }
+    save_atomic(os.path.join(get_parts_folder(folder), 'part-%s.npz'%part), data)
+
+def write_matrix_part(folder, rows, part):
+    # Rows are (gene file name, interactor genes, scores), interactors ranked best first
+    lengths = [ len(r[1]) for r in rows ]
+    codes, names = pd.factorize(np.concatenate([ np.asarray(r[1], dtype=object) for r in rows ] + [np.array([], dtype=object)]))
+    save_part(folder, part, [ r[0] for r in rows ], np.concatenate([[0], np.cumsum(lengths)]),
+              np.asarray(names, dtype=str), codes, np.concatenate([ np.asarray(r[2], dtype=np.float64) for r in rows ] + [np.array([])]))
+
+def read_part(filename):
+    # Files, indptr, names, codes and scores of a part (parts saved with interactor strings are coded when read)
+    with np.load(filename) as part:
+        if 'interactors' in part.files:
+            codes, names = pd.factorize(part['interactors'])
+            return part['files'], part['indptr'], np.asarray(names, dtype=str), codes, part['scores']
+        return part['files'], part['indptr'], part['names'], part['codes'], part['scores']
+
+def get_ranges(starts, lengths):
+    # Positions starts[k] ... starts[k] + lengths[k] - 1 of every k, one after another
+    lengths = np.asarray(lengths, dtype=np.int64)
+    return np.repeat(np.asarray(starts, dtype=np.int64) - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+def get_parts(folder):
+    return sorted([ f for f in os.listdir(get_parts_folder(folder)) if f.startswith('part-') and f.endswith('.npz') ])
+
+def read_matrix_parts(folder):
+    # All rows as (files, indptr, names, codes, scores) ordered by file, later parts replace rows of earlier parts for the same gene file
+    parts = get_parts(folder)
+    seen = set()
+    names, kept = [], []
+    for p in reversed(parts):
+        files, indptr, part_names, codes, scores = read_part(os.path.join(get_parts_folder(folder), p))
+        rows = np.array([ i for i, f in enumerate(files.tolist()) if f not in seen ], dtype=np.int64)
+        seen.update(files.tolist())
+        lengths = indptr[rows + 1] - indptr[rows]
+        entries = get_ranges(indptr[rows], lengths)
+        # Only names of the rows kept join the vocabulary
+        used = np.zeros(part_names.shape[0], dtype=bool)
+        used[codes[entries]] = True
+        names.append(part_names[used])
+        kept.append((files[rows], lengths, part_names, codes[entries], scores[entries]))
+    names = pd.Index(np.sort(pd.unique(np.concatenate(names + [np.array([], dtype=str)]))))
+
+    # Codes of every part into the shared names, rows ordered by file
+    files = np.concatenate([ k[0] for k in kept ] + [np.array([], dtype=str)])
+    lengths = np.concatenate([ k[1] for k in kept ] + [np.array([], dtype=np.int64)])
+    codes = np.concatenate([ names.get_indexer(k[2])[k[3]] for k in kept ] + [np.array([], dtype=np.int64)])
+    scores = np.concatenate([ k[4] for k in kept ] + [np.array([], dtype=np.float32)])
+    order = np.argsort(files, kind='mergesort')
+    entries = get_ranges((np.cumsum(lengths) - lengths)[order], lengths[order])
+    return (files[order], np.concatenate([[0], np.cumsum(lengths[order])]), names.values, codes[entries], scores[entries]), parts
+
+def get_matrix_files(folder):
+    # Gene files with a row saved in any part, only the file names of each part are read
+    if not os.path.exists(get_parts_folder(folder)):
+        return set()
+    files = set()
+    for p in get_parts(folder):
+        with np.load(os.path.join(get_parts_folder(folder), p)) as part:
+            files.update([ str(f) for f in part['files'] ])
+    return files
+
+def build_matrix(folder):
+    # Assemble all parts into CSR and CSC arrays over one gene vocabulary
+    if not os.path.exists(get_parts_folder(folder)):
+        print('No matrix parts in %s'%folder)
+        return
+    # Nothing to do if no parts were added since the matrix was last built
+    parts = get_parts(folder)
+    vocabulary_file = os.path.join(folder, 'vocabulary.json')
+    if parts == ['part-0-all.npz'] and os.path.exists(vocabulary_file) and \
+            os.path.getmtime(vocabulary_file) >= os.path.getmtime(os.path.join(get_parts_folder(folder), parts[0])):
+        print('Matrix in %s is up to date'%folder)
+        return
+    (files, file_indptr, names, codes, scores), parts = read_matrix_parts(folder)
+
+    # Keep parts as one file so later runs add to the same matrix
+    if files.shape[0] > 0 and parts != ['part-0-all.npz']:
+        save_part(folder, '0-all', files, file_indptr, names, codes, scores)
+        for p in parts:
+            if p != 'part-0-all.npz':
+                os.remove(os.path.join(get_parts_folder(folder), p))
+
+    # One row per gene, first isoform file if several were exported (e.g. run with --all)
+    row_files, row_index = {}, {}
+    for i, f in enumerate(files.tolist()):
+        if get_gene(f) not in row_files:
+            row_files[get_gene(f)], row_index[get_gene(f)] = f, i
+    rows = np.array(list(row_index.values()), dtype=np.int64)
+    row_lengths = file_indptr[rows + 1] - file_indptr[rows]
+    used = np.unique(codes[get_ranges(file_indptr[rows], row_lengths)])
+    genes = pd.Index(np.sort(pd.unique(np.concatenate([np.array(list(row_files), dtype=str), names[used]]))))
+
+    # CSR, rows keep the ranked order of extract_top_genes.py (ties by position in the gene file)
+    row_codes = genes.get_indexer(list(row_files))
+    order = np.argsort(row_codes)
+    lengths = np.zeros(genes.shape[0], dtype=np.int64)
+    lengths[row_codes] = row_lengths
+    indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    entries = get_ranges(file_indptr[rows[order]], row_lengths[order])
+    indices = genes.get_indexer(names)[codes[entries]].astype(np.int32)
+    data = scores[entries].astype(np.float32)
+
+    # CSC, each column by descending score then row, keeping rank of the entry within its row
+    entry_rows = np.repeat(np.arange(genes.shape[0], dtype=np.int32), lengths)
+    entry_ranks = (np.arange(indices.shape[0]) - np.repeat(indptr[:-1], lengths)).astype(np.int32)
+    by_column = np.lexsort((entry_rows, -data, indices))
+    csc_indptr = np.concatenate([[0], np.cumsum(np.bincount(indices, minlength=genes.shape[0]))]).astype(np.int64)
+
+    arrays = {
+        'csr_indptr': indptr, 'csr_indices': indices, 'csr_data': data,
+        'csc_indptr': csc_indptr, 'csc_indices': entry_rows[by_column], 'csc_data': data[by_column], 'csc_ranks': entry_ranks[by_column],
+        }
+    for name, array in arrays.items():
+        save_atomic(os.path.join(folder, name + '.npy'), array)
+    save_atomic(os.path.join(folder, 'vocabulary.json'), {'genes': list(genes), 'files': row_files})
+    print('Matrix of %s genes, %s rows, %s scores saved to %s'%(genes.shape[0], len(row_files), data.shape[0], folder))
+
+def load_matrix(folder):
+    # Arrays are memory-mapped, only the slices queried are read from disk
+    with open(os.path.join(folder, 'vocabulary.json')) as fh:
+        vocabulary = json.load(fh)
+    matrix = dict(( (name, np.load(os.path.join(folder, name + '.npy'), mmap_mode='r')) for name in CSR_ARRAYS + CSC_ARRAYS ))
+    matrix['genes'] = pd.Index(vocabulary['genes'])
+    matrix['files'] = vocabulary['files']
+    return matrix
+
+def get_code(matrix, gene):
+    # Accept gene names with or without isoform number
+    code = matrix['genes'].get_indexer([gene, get_gene(gene)])
+    if code[0] >= 0:
+        return code[0]
+    if code[1] >= 0:
+        return code[1]
+    raise KeyError('%s not in matrix'%gene)
+
+def row_top(matrix, gene, k=None):
+    # Top k interactors of gene, best first
+    code = get_code(matrix, gene)
+    start, end = matrix['csr_indptr'][code], matrix['csr_indptr'][code+1]
+    if k is not None:
+        end = min(end, start + k)
+    return pd.DataFrame({'interactor': matrix['genes'].values[matrix['csr_indices'][start:end]],
+                         'score': np.asarray(matrix['csr_data'][start:end]),
+                         'rank': np.arange(1, end - start + 1)})
+
+def column_top(matrix, gene, k=None):
+    # Top k genes scoring gene as interactor, best first, with the rank gene has in each of their rows
+    code = get_code(matrix, gene)
+    start, end = matrix['csc_indptr'][code], matrix['csc_indptr'][code+1]
+    if k is not None:
+        end = min(end, start + k)
+    return pd.DataFrame({'gene': matrix['genes'].values[matrix['csc_indices'][start:end]],
+                         'score': np.asarray(matrix['csc_data'][start:end]),
+                         'rank': np.asarray(matrix['csc_ranks'][start:end]) + 1})
+
+def reciprocal(matrix, gene, k=None):
+    # Interactors in the top k of gene that also have gene in their own top k, gene itself is never its own partner
+    top = row_top(matrix, gene, k)
+    code = get_code(matrix, gene)
+    top = top[top['interactor'] != matrix['genes'][code]]
+    start, end = matrix['csc_indptr'][code], matrix['csc_indptr'][code+1]
+    ranks = np.asarray(matrix['csc_ranks'][start:end])
+    keep = np.asarray(matrix['csc_indices'][start:end]) != code
+    if k is not None:
+        keep &= ranks < k
+    back = pd.DataFrame({'interactor': matrix['genes'].values[np.asarray(matrix['csc_indices'][start:end])[keep]],
+                         'reverse_score': np.asarray(matrix['csc_data'][start:end])[keep],
+                         'reverse_rank': ranks[keep] + 1})
+    return top.merge(back, on='interactor')
+
+QUERIES = {'row': row_top, 'column': column_top, 'reciprocal': reciprocal}
+
+# MAIN RUN
+if __name__ == '__main__':
+    # DEFINE COMMANDLINE ARGUMENTS
+    describe_help = 'python interaction_matrix.py -m PATH_TO_MATRIX_FOLDER/ -g Glyma.18G022500 -q reciprocal -k 20'
+    parser = argparse.ArgumentParser(description=describe_help)
+    parser.add_argument('-m', '--matrix', help='Full path to matrix folder written by extract_top_genes.py -x', type=str)
+    parser.add_argument('-g', '--genes', help='Gene(s) to query', type=str, nargs='+', default=[])
+    parser.add_argument('-q', '--query', help='Query type', type=str, choices=list(QUERIES), default='row')
+    parser.add_argument('-k', '--top', help='Number of top entries to return (all if not given)', type=int, default=None)
+    parser.add_argument('-b', '--build', help='Flag to (re)build the matrix from saved parts', action='store_true')
+    parser.add_argument('-o', '--output', help='Full path to .csv file for query results', type=str, default=None)
+    args = parser.parse_args()
+
+    if args.build:
+        build_matrix(args.matrix)
+
+    matrix = load_matrix(args.matrix)
+    results = []
+    for gene in args.genes:
+        try:
+            result = QUERIES[args.query](matrix, gene, args.top)
+        except KeyError as e:
+            print(e)
+            continue
+        result.insert(0, 'query', gene)
+        results.append(result)
+        print('\n%s %s:\n%s'%(args.query, gene, result.to_string(index=False)))
+
+    if args.output is not None and len(results) > 0:
+        pd.concat(results).to_csv(args.output, index=False)
@@ -12,127 +12,134 @@ import pandas as pd
 import numpy as np
 import tqdm
 import time
-from openpyxl import load_workbook
-from openpyxl.worksheet.worksheet import Worksheet
+import atexit
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, Border, Side, Alignment
+from instrumentation import start_log, stage, log_file, summarize, start_profile, stop_profile
+
+# EXCEL HEADER STYLE AS WRITTEN BY PANDAS
+HEADER_FONT = Font(bold=True)
+HEADER_BORDER = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
+HEADER_ALIGNMENT = Alignment(horizontal='center', vertical='top')
+# Longest sheet name Excel allows
+MAX_SHEET_NAME = 31
 
 # DEFINE COMMANDLINE ARGUMENTS
-describe_help = 'python organize_gene_results.py -f chromosome_1.xlsx -r result_filename.xlsx'
+describe_help = 'python organize_gene_results.py -f chromosome_1.csv -r result_filename.xlsx'
 parser = argparse.ArgumentParser(description=describe_help)
-parser.add_argument('-f', '--file', help='Full path to file for input', type=str)
-parser.add_argument('-t', '--threshold', help='Threshold percentage for filtering', type=float, default=25)
+parser.add_argument('-f', '--file', help='Full path to file(s) for input, a folder uses all .csv files in it', type=str, nargs='+')
+parser.add_argument('-t', '--threshold', help='Threshold percentage(s) for filtering', type=float, nargs='+', default=[25])
 parser.add_argument('-r', '--result', help='Full path to result file for output', type=str, default=os.getcwd() + '/organized_results.xlsx')
+parser.add_argument('-log', '--log', help='JSON lines file for stage and file timings (default is <result>_log.jsonl)', type=str, default=None)
+parser.add_argument('-profile', '--profile', help='File to save cProfile stats of the run to', type=str, default=None)
 args = parser.parse_args()
 
-# MAIN RUN
-if __name__ == '__main__':
-    t_start = time.time()
-    # Show args for double-checking input
-    print(args)
-    
-    # Read file
-    print('Reading file...')
-    df = pd.read_csv(args.file, na_values=['NO'])
-    df.drop(index=df[df[df.columns[0]].isna()].index, inplace=True)
-    #df.replace(to_replace=np.nan, value=0, inplace=True)
-    
-    num_cols = df.shape[1] - 1
+def get_input_files(paths):
+    # Expand folders to the .csv files they contain, e.g. one file per chromosome
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted([ os.path.join(path, f) for f in os.listdir(path) if f.endswith('.csv') ]))
+        else:
+            files.append(path)
+    return files
+
+def read_scores(filename):
     # Columns are either Gene name, PIPE soy-soy score
     # OR
     # Gene name, SPRINT, soy-soy score
     # OR
-    # Gene name, PIPE soy-soy score, SPRINT soy-soy score
+    # Gene name, PIPE soy-soy score, SPRINT soy-soy score, ... (any number of score columns)
     # Columns also go in descending % (ranges 100% - 0%)
+    df = pd.read_csv(filename, na_values=['NO'])
+    df = df[df[df.columns[0]].notna()].reset_index(drop=True)
+    return df
+
+def group_by_criteria(df, threshold):
+    # Number of score columns each gene passes, missing scores never pass
+    scores = df[df.columns[1:]]
+    passed = (scores.values >= threshold) & scores.notna().values
+    num_passed = passed.sum(axis=1)
     
-    print('Processing data...')
-    # For file with ONLY PIPE or SPRINT columns
-    if num_cols == 1:
-        # Group genes based on desired criteria
-        # Add gene for number of occurences in each criteria
-        df_count = df.append(df[df[df.columns[1]] >= args.threshold])
-        
-        # Count number of occurrences
-        counts = df_count.value_counts(subset=[df_count.columns[0]])
-        counts = counts - 1
-        gene_counts = counts.reset_index()
-        
-        # Passed threshold
-        one = df[df[df.columns[0]].isin(gene_counts[gene_counts[gene_counts.columns[-1]] == 1][gene_counts.columns[0]])].sort_values(by=[df.columns[1]], ascending=False)
-        # Didn't pass threshold
-        zero = df[df[df.columns[0]].isin(gene_counts[gene_counts[gene_counts.columns[-1]] == 0][gene_counts.columns[0]])].sort_values(by=df.columns[1], ascending=False)
+    # Within a group, genes passing earlier criteria come first (e.g. passed PIPE only before passed SPRINT only),
+    # then genes are sorted by the scores they passed followed by the scores they failed
+    patterns = pd.DataFrame(passed, columns=scores.columns)
+    groups = []
+    for g in range(0, scores.shape[1] + 1):
+        in_group = patterns[num_passed == g]
+        ordered = []
+        for pattern, rows in sorted(in_group.groupby(list(scores.columns)).groups.items(), reverse=True):
+            pattern = pattern if isinstance(pattern, tuple) else (pattern,)
+            by = [ c for c, p in zip(scores.columns, pattern) if p ] + [ c for c, p in zip(scores.columns, pattern) if not p ]
+            ordered.append(df.loc[rows].sort_values(by=by, ascending=False, kind='mergesort'))
+        groups.append(pd.concat(ordered) if len(ordered) > 0 else df.iloc[:0])
+    return groups
 
-        groups = [zero, one]
-        
-    elif num_cols == 2:
-        
-        # Group genes based on desired criteria
-        # Add gene for number of occurences in each criteria
-        df_count = df.append(df[df[df.columns[1]] >= args.threshold])
-        df_count = df_count.append(df[df[df.columns[1]] >= args.threshold])
-        
-        # Count number of occurrences
-        counts = df_count.value_counts(subset=[df_count.columns[0]])
-        counts = counts - 1
-        gene_counts = counts.reset_index()
-        
-        # Passed both criteria
-        two = df[df[df.columns[0]].isin(gene_counts[gene_counts[gene_counts.columns[-1]] == 2][gene_counts.columns[0]])].sort_values(by=[df.columns[1], df.columns[2]], ascending=False)
-        # PIPE soy-soy AND SPRINT soy-soy
-        two = two[(two[two.columns[1]] >= args.threshold)
-                        & (two[two.columns[2]] >= args.threshold)].sort_values(by=[df.columns[1], df.columns[2]], ascending=False)
-        
-        # Passed only one criteria
-        one = df[df[df.columns[0]].isin(gene_counts[gene_counts[gene_counts.columns[-1]] == 1][gene_counts.columns[0]])].sort_values(by=[df.columns[1]], ascending=False)
-        # Passed one (PIPE or SPRINT)
-        one_first = one[(one[one.columns[1]] >= args.threshold) & (one[one.columns[2]] < args.threshold) ].sort_values(by=[df.columns[1], df.columns[2]], ascending=False)
-        # Passed other (PIPE or SPRINT)
-        one_second  = one[(one[one.columns[2]] >= args.threshold) & (one[one.columns[1]] < args.threshold) ].sort_values(by=[df.columns[2], df.columns[1]], ascending=False)
-        # Combine
-        one_all = pd.concat([one_first, one_second])
-        
-        # Didn't pass either criteria
-        zero = df[df[df.columns[0]].isin(gene_counts[gene_counts[gene_counts.columns[-1]] == 0][gene_counts.columns[0]])].sort_values(by=df.columns[1], ascending=False)
+def write_sheet(ws, groups):
+    # Stream one block per group from most to least criteria passed, each under a labelled row and followed by a blank row
+    columns = ['Gene Name'] + [ c for c in groups[0].columns if c != 'Gene Name' ]
+    header = []
+    for c in columns:
+        cell = WriteOnlyCell(ws, value=c)
+        cell.font, cell.border, cell.alignment = HEADER_FONT, HEADER_BORDER, HEADER_ALIGNMENT
+        header.append(cell)
+    ws.append(header)
+    
+    for g in range(len(groups) - 1, -1, -1):
+        ws.append(['PASSED %s CRITERIA (%s genes)'%(g, groups[g].shape[0])])
+        group = groups[g].reindex(columns=columns)
+        values = group.astype(object).where(group.notna(), None).values
+        for row in values:
+            ws.append(list(row))
+        ws.append([])
 
-        groups = [zero, one_all, two]
+def get_sheet_name(filename, threshold, batch):
+    # Single file and threshold keep Sheet1, batch results get one sheet per file and threshold
+    if not batch:
+        return 'Sheet1'
+    name = '%s %g'%(os.path.splitext(os.path.basename(filename))[0], threshold)
+    return name[-MAX_SHEET_NAME:]
 
-    else:
-        print("Check number of columns in file")
-        #exit()
+# MAIN RUN
+if __name__ == '__main__':
+    # Show args for double-checking input
+    print(args)
     
-    print('Creating organized results...')
-    final = pd.DataFrame()
-    for g in range(len(groups) - 1, -1, -1):
-        final = final.append(pd.DataFrame(data={'Gene Name': ['PASSED %s CRITERIA (%s genes)'%(g, groups[g].shape[0])]}))
-        final = final.append(groups[g])
-        final = final.append(pd.DataFrame(data={'Gene Name': ['']}))
-        
+    # Timings are logged while running, summary (and profile) printed however the run ends
+    start_log(args.log if args.log is not None else os.path.splitext(args.result)[0] + '_log.jsonl', script='organize_gene_results_all_analysis.py', args=vars(args))
+    profiler = start_profile(args.profile)
+    atexit.register(summarize)
+    atexit.register(stop_profile, profiler, args.profile)
     
-    # Output to file
-    # Create file to append if not existing
-    if not os.path.exists(args.result):
-        writer = pd.ExcelWriter(args.result, engine='openpyxl')
-        pd.DataFrame().to_excel(writer, sheet_name='Sheet1', index=False)
-        writer.save()
-        writer.close()
+    files = get_input_files(args.file)
+    batch = len(files) * len(args.threshold) > 1
+    print('%s files, %s thresholds'%(len(files), len(args.threshold)))
     
-    print('Writing to file...')
-    # Load file
-    book = load_workbook(args.result)
-    writer = pd.ExcelWriter(args.result, engine='openpyxl', mode='a')
-    writer.book = book
-    writer.sheets = dict((ws.title, ws) for ws in book.worksheets)
+    # All sheets go through one write-only workbook, rows are streamed as each file is organized
+    book = Workbook(write_only=True)
+    for filename in tqdm.tqdm(files):
+        # Read file
+        t_read = time.perf_counter()
+        df = read_scores(filename)
+        log_file(filename, time.perf_counter() - t_read, bytes=os.path.getsize(filename), rows=df.shape[0], columns=df.shape[1])
+        if df.shape[1] < 2:
+            print("Check number of columns in file %s"%filename)
+            continue
+        
+        for threshold in args.threshold:
+            # Group genes based on number of criteria passed
+            with stage('group', file=filename, threshold=threshold) as fields:
+                groups = group_by_criteria(df, threshold)
+                fields['genes_per_group'] = [ g.shape[0] for g in groups ]
+            with stage('sheet_rows', file=filename, threshold=threshold):
+                write_sheet(book.create_sheet(get_sheet_name(filename, threshold, batch)), groups)
     
-    final.to_excel(writer, sheet_name='Sheet1', index=False)
+    print('Writing to file...')
+    # Replace file only once completely written
+    tmp = '%s.%s.tmp'%(args.result, os.getpid())
+    with stage('excel_writing', result=args.result):
+        book.save(tmp)
+        os.replace(tmp, args.result)
     
-    '''
-    # Write grouping result
-    for g in range(len(groups) - 1, -1, -1):
-        groups[g].to_excel(writer, sheet_name='Sheet1', index=False)
-        pd.DataFrame(columns=['Group %s'%g]).to_excel(writer, sheet_name='Sheet1', index=False)
-    '''
-    writer.save()
-    writer.close()
-
     print('Done!')
-    
-    
-    
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Description:
+    Score genes from the ranked interactor lists saved by extract_top_genes.py -x (see interaction_matrix.py)
+    For each matrix (e.g. soy-soy and soy-pathogen runs) and each gene:
+        i) Genes of interest in top N interactors, % and hypergeometric enrichment p-value against the interest panel
+        ii) Reciprocal top N partners (interactors that also have the gene in their own top N)
+            and the best reciprocal partner by rank product sqrt(rank of partner for gene x rank of gene for partner)
+    Across matrices:
+        iii) Consensus rank product, geometric mean of the gene's enrichment rank (as a fraction of genes ranked) in each matrix
+
+    Everything is computed on arrays of the top N entries of all rows at once, memory grows with genes x N, never genes x genes
+
+Usage:
+    python score_top_genes.py -m <PATH_TO_MATRIX_FOLDER/> [<PATH_TO_MATRIX_FOLDER/> ...] -t <number_of_top_scorers> -r <path_to_result_filename.csv>
+
+        e.g.
+        python score_top_genes.py -m Documents/SOY/soy_soy_matrix/ Documents/SOY/soy_pathogen_matrix/ -t 40 -r Documents/SOY/scores.csv
+
+        Add -i <path_to_genes_file> to use another list of genes of interest (one gene per line) instead of GENES_OF_INTEREST
+        Add -u <number_of_genes> to set the population of the enrichment test (default is all interactor genes in the matrix)
+"""
+
+import os
+import argparse
+import pandas as pd
+import numpy as np
+from interaction_matrix import load_matrix
+from extract_top_genes import GENES_OF_INTEREST, load_genes_of_interest
+
+# DEFINE COMMANDLINE ARGUMENTS
+describe_help = 'python score_top_genes.py -m PATH_TO_MATRIX_FOLDER/ -t 40 -r scores.csv'
+parser = argparse.ArgumentParser(description=describe_help)
+parser.add_argument('-m', '--matrix', help='Full path to matrix folder(s) written by extract_top_genes.py -x', type=str, nargs='+')
+parser.add_argument('-n', '--names', help='Name of each matrix for result columns (default is folder name)', type=str, nargs='+', default=None)
+parser.add_argument('-t', '--top', help='Number of top interactors to score', type=int, default=20)
+parser.add_argument('-i', '--interest', help='File with genes of interest (one per line) to use instead of GENES_OF_INTEREST', type=str, default=None)
+parser.add_argument('-u', '--population', help='Number of genes in enrichment test population', type=int, default=None)
+parser.add_argument('-r', '--result', help='Full path to result .csv file', type=str, default=os.getcwd() + '/top_gene_scores.csv')
+
+def get_top_entries(matrix, top):
+    # Row, column and rank (0 is best) of the top entries of every row of the matrix
+    indptr = np.asarray(matrix['csr_indptr'])
+    lengths = np.minimum(np.diff(indptr), top)
+    rows = np.repeat(np.arange(lengths.shape[0]), lengths)
+    ranks = np.arange(rows.shape[0]) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    cols = np.asarray(matrix['csr_indices'][indptr[rows] + ranks]).astype(np.int64)
+    return rows, cols, ranks
+
+def get_reverse_ranks(rows, cols, ranks, num_genes):
+    # Rank of row gene in the top entries of column gene, -1 if not there
+    keys = rows.astype(np.int64) * num_genes + cols
+    reverse = cols * num_genes + rows
+    order = np.argsort(keys, kind='mergesort')
+    pos = np.minimum(np.searchsorted(keys[order], reverse), max(keys.shape[0] - 1, 0))
+    found = keys[order][pos] == reverse if keys.shape[0] > 0 else np.zeros(0, dtype=bool)
+    return np.where(found, ranks[order][pos], -1)
+
+def log_choose(log_factorial, n, k):
+    k = np.clip(k, 0, n)
+    return log_factorial[n] - log_factorial[k] - log_factorial[n - k]
+
+def enrichment_pvalues(hits, draws, successes, population):
+    # Hypergeometric P(X >= hits) of drawing draws genes from population with successes genes of interest,
+    # all possible numbers of hits of every gene are summed at once (draws is at most the number of top interactors)
+    log_factorial = np.concatenate([[0], np.cumsum(np.log(np.arange(1, population + 1)))])
+    draws = np.minimum(draws, population)
+    i = np.arange(0, draws.max() + 1 if draws.shape[0] > 0 else 1)[None, :]
+    valid = (i >= hits[:, None]) & (i <= np.minimum(draws, successes)[:, None]) & (draws[:, None] - i <= population - successes)
+    log_p = log_choose(log_factorial, successes, i) + log_choose(log_factorial, population - successes, draws[:, None] - i) \
+        - log_choose(log_factorial, population, draws)[:, None]
+    p = np.where(valid, np.exp(np.where(valid, log_p, 0)), 0).sum(axis=1)
+    return np.minimum(p, 1)
+
+def score_matrix(matrix, top, interest, population=None):
+    # One row per gene with ranked interactors in matrix
+    genes = matrix['genes']
+    rows, cols, ranks = get_top_entries(matrix, top)
+    draws = np.bincount(rows, minlength=genes.shape[0])
+    has_row = np.diff(np.asarray(matrix['csr_indptr'])) > 0
+
+    # Genes of interest in top interactors
+    is_interest = genes.isin(interest)
+    hits = np.bincount(rows, weights=is_interest[cols], minlength=genes.shape[0]).astype(np.int64)
+    if population is None:
+        # Every gene found as an interactor of any gene
+        in_population = np.diff(np.asarray(matrix['csc_indptr'])) > 0
+        population = int(in_population.sum())
+        successes = int((in_population & is_interest).sum())
+    else:
+        successes = len(interest)
+    pvalues = enrichment_pvalues(hits, draws, successes, population)
+
+    # Reciprocal top partners, best one by rank product (ties by higher rank of partner for gene)
+    # A gene scoring itself is never its own partner, it still counts in top and interest_count like in extract_top_genes.py results
+    reverse_ranks = get_reverse_ranks(rows, cols, ranks, genes.shape[0])
+    reciprocal = (reverse_ranks >= 0) & (rows != cols)
+    rank_product = np.sqrt((ranks[reciprocal] + 1.0) * (reverse_ranks[reciprocal] + 1.0))
+    order = np.lexsort((ranks[reciprocal], rank_product, rows[reciprocal]))
+    best_rows, first = np.unique(rows[reciprocal][order], return_index=True)
+    best_partner = np.full(genes.shape[0], None, dtype=object)
+    best_partner[best_rows] = genes.values[cols[reciprocal][order][first]]
+    best_rank_product = np.full(genes.shape[0], np.nan)
+    best_rank_product[best_rows] = rank_product[order][first]
+
+    scores = pd.DataFrame({
+        'top': draws,
+        'interest_count': hits,
+        'percent_interested': hits / top * 100,
+        'enrichment_p': pvalues,
+        'reciprocal_count': np.bincount(rows[reciprocal], minlength=genes.shape[0]),
+        'best_reciprocal_partner': best_partner,
+        'best_rank_product': best_rank_product,
+        }, index=genes)
+    scores = scores[has_row]
+    # Rank of gene within matrix, most enriched first
+    scores['enrichment_rank'] = scores['enrichment_p'].rank(method='average')
+    return scores
+
+def consensus_rank_product(scores):
+    # Geometric mean of enrichment rank as a fraction of genes ranked in each matrix the gene is in
+    relative = pd.concat([ s['enrichment_rank'] / s.shape[0] for s in scores ], axis=1)
+    return np.exp(np.log(relative).mean(axis=1)), relative.notna().sum(axis=1)
+
+# MAIN RUN
+if __name__ == '__main__':
+    args = parser.parse_args()
+    # Show args for double-checking input
+    print(args)
+
+    interest = GENES_OF_INTEREST if args.interest is None else load_genes_of_interest(args.interest)
+    if args.names is not None:
+        names = args.names
+    else:
+        # Folder name, or path relative to the folder all matrices share if names repeat (e.g. soy_soy/matrix and soy_pathogen/matrix)
+        names = [ os.path.basename(os.path.normpath(m)) for m in args.matrix ]
+        if len(set(names)) < len(names) and len(args.matrix) > 1:
+            common = os.path.commonpath([ os.path.abspath(m) for m in args.matrix ])
+            names = [ os.path.relpath(os.path.abspath(m), common) for m in args.matrix ]
+    if len(names) != len(args.matrix):
+        parser.error('%s names given for %s matrices'%(len(names), len(args.matrix)))
+    if len(set(names)) < len(names):
+        parser.error('matrix names must be different, got %s'%', '.join(names))
+
+    results = []
+    for name, folder in zip(names, args.matrix):
+        print('Scoring %s...'%folder)
+        scores = score_matrix(load_matrix(folder), args.top, interest, population=args.population)
+        print('\t%s genes, %s with reciprocal top %s partners'%(scores.shape[0], (scores['reciprocal_count'] > 0).sum(), args.top))
+        results.append(scores)
+
+    final = pd.concat([ s.add_prefix(name + ' ') for name, s in zip(names, results) ], axis=1)
+    final['consensus_rank_product'], final['matrices'] = consensus_rank_product(results)
+    final.index.name = 'Gene Name'
+    final = final.sort_values(by=['consensus_rank_product'], kind='mergesort')
+    final.to_csv(args.result)
+    print('Saved %s genes to %s'%(final.shape[0], args.result))